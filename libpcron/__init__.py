@@ -24,5 +24,6 @@ __copyright__ = "(C) 2009-2016 Lars Gustäbel <lars@gustaebel.de>"
 
 ENVIRONMENT_NAME = "environment.sh"
 CRONTAB_NAME = "crontab.ini"
+CALENDARS_NAME = "calendars.ini"
 PID_NAME = "pcron.pid"
 SUPPORTED_SHELLS = set(["sh", "bash", "ksh", "zsh", "dash"])
@@ -0,0 +1,143 @@
+# -----------------------------------------------------------------------
+#
+# pcron - a periodic cron-like job scheduler.
+# Copyright (C) 2009-2016 Lars Gustäbel <lars@gustaebel.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+# -----------------------------------------------------------------------
+
+# A calendars.ini file defines named sets of days, e.g. public holidays. Jobs
+# that refer to a calendar in their `calendar' variable are not run on these
+# days. For example:
+#
+#   [holidays]
+#   dates:  01-01 12-24..12-26
+#           2025-04-18 2025-04-21
+#
+# A date with a year applies to that year only, a date without a year to every
+# year. A range of dates is given as `<first>..<last>'.
+
+import re
+import datetime
+
+from .shared import CrontabError
+
+
+class Calendar:
+    """A named set of days. For each year that is asked for, the days are
+       compiled into a bitmap with one bit per day of the year, so that a
+       lookup costs a single bit test.
+    """
+
+    r_date = re.compile(r"^(?:(?P<year>\d{4})-)?(?P<month>\d{1,2})-(?P<day>\d{1,2})$")
+
+    # The calendars.ini file has no settings like the crontab has.
+    settings = {}
+
+    def __init__(self, name, entries=()):
+        self.name = name
+        self.entries = list(entries)
+        self.bitmaps = {}
+
+    @classmethod
+    def parse(cls, name, value):
+        """Create a calendar from a whitespace or comma separated list of
+           dates and date ranges.
+        """
+        entries = []
+        for spec in value.replace(",", " ").split():
+            first, sep, last = spec.partition("..")
+            first = cls.parse_date(first)
+            last = cls.parse_date(last) if sep else first
+
+            if (first[0] is None) != (last[0] is None):
+                raise CrontabError("range %r mixes dates with and without year" % spec)
+            if last < first:
+                raise CrontabError("range %r ends before it starts" % spec)
+            entries.append((first, last))
+        return cls(name, entries)
+
+    @classmethod
+    def parse_date(cls, value):
+        match = cls.r_date.match(value)
+        if match is None:
+            raise CrontabError("invalid date:%r" % value)
+
+        year = int(match.group("year")) if match.group("year") else None
+        month, day = int(match.group("month")), int(match.group("day"))
+        try:
+            # 2000 is a leap year, so that 02-29 is accepted without a year.
+            datetime.date(2000 if year is None else year, month, day)
+        except ValueError:
+            raise CrontabError("invalid date:%r" % value)
+        return year, month, day
+
+    @classmethod
+    def combine(cls, calendars):
+        """Return a calendar with the days of all calendars.
+        """
+        return cls("+".join(calendar.name for calendar in calendars),
+                   [entry for calendar in calendars for entry in calendar.entries])
+
+    def get_bitmap(self, year):
+        """Return the days of a year as an integer in which bit n stands for
+           the n-th day of the year (counting from 0).
+        """
+        bitmap = self.bitmaps.get(year)
+        if bitmap is None:
+            bitmap = self.bitmaps[year] = self.compile(year)
+        return bitmap
+
+    def compile(self, year):
+        start = datetime.date(year, 1, 1).toordinal()
+        stop = datetime.date(year + 1, 1, 1).toordinal()
+
+        bitmap = 0
+        for (first_year, first_month, first_day), (last_year, last_month, last_day) in self.entries:
+            if first_year is None:
+                first_year = last_year = year
+            try:
+                first = datetime.date(first_year, first_month, first_day).toordinal()
+            except ValueError:
+                # 02-29 in a year that is not a leap year.
+                first = datetime.date(first_year, 3, 1).toordinal()
+            try:
+                last = datetime.date(last_year, last_month, last_day).toordinal()
+            except ValueError:
+                last = datetime.date(last_year, 2, 28).toordinal()
+
+            first = max(first, start)
+            last = min(last, stop - 1)
+            if first <= last:
+                bitmap |= ((1 << (last - first + 1)) - 1) << (first - start)
+        return bitmap
+
+    def __contains__(self, date):
+        return bool(self.get_bitmap(date.year) >> (date.timetuple().tm_yday - 1) & 1)
+
+    def __repr__(self):
+        return "<calendar %s>" % self.name
+
+
+def resolve_calendars(calendars, names, cache):
+    """Return the calendar for a list of calendar names. Jobs with the same
+       list share the same calendar object by way of the cache dictionary.
+    """
+    key = tuple(names)
+    if key not in cache:
+        cache[key] = calendars[key[0]] if len(key) == 1 else \
+                Calendar.combine([calendars[name] for name in key])
+    return cache[key]
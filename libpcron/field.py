@@ -99,6 +99,127 @@ class ListOfStrings(String):
         return values
 
 
+class Integer(_Field):
+
+    def __init__(self, default=NODEFAULT, schedule=False, minimum=None, maximum=None):
+        super().__init__(default, schedule)
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def _convert(self, value):
+        value = super()._convert(value)
+        try:
+            value = int(value)
+        except ValueError:
+            raise CrontabError("invalid integer value:%r" % value)
+
+        if self.minimum is not None and value < self.minimum:
+            raise CrontabError("value %d is less than %d" % (value, self.minimum))
+        if self.maximum is not None and value > self.maximum:
+            raise CrontabError("value %d is greater than %d" % (value, self.maximum))
+        return value
+
+
+class Size(_Field):
+
+    r_size = re.compile(r"^(?P<number>\d+)(?P<unit>[kmgt]?)b?$", re.IGNORECASE)
+
+    units = {"": 1, "k": 1 << 10, "m": 1 << 20, "g": 1 << 30, "t": 1 << 40}
+
+    def _convert(self, value):
+        value = super()._convert(value)
+        match = self.r_size.match(value.strip())
+        if match is None:
+            raise CrontabError("invalid size value:%r" % value)
+        return int(match.group("number")) * self.units[match.group("unit").lower()]
+
+
+class IoPriority(_Field):
+
+    classes = {"realtime": 1, "best-effort": 2, "idle": 3}
+
+    def _convert(self, value):
+        value = super()._convert(value)
+        name, _, level = value.partition(":")
+        try:
+            ioclass = self.classes[name]
+        except KeyError:
+            raise CrontabError("invalid io scheduling class:%r" % name)
+
+        if not level:
+            return ioclass, None
+        elif ioclass == 3:
+            raise CrontabError("io scheduling class idle takes no level")
+        elif level not in ("0", "1", "2", "3", "4", "5", "6", "7"):
+            raise CrontabError("invalid io priority level:%r" % level)
+        return ioclass, int(level)
+
+
+class CpuList(_Field):
+
+    r_cpu_list = re.compile(r"^\d+(-\d+)?(,\d+(-\d+)?)*$")
+
+    def _convert(self, value):
+        value = super()._convert(value).replace(" ", "")
+        if self.r_cpu_list.match(value) is None:
+            raise CrontabError("invalid cpu list:%r" % value)
+
+        for part in value.split(","):
+            first, _, last = part.partition("-")
+            if last and int(last) < int(first):
+                raise CrontabError("invalid cpu range:%r" % part)
+        return value
+
+
+class LoadThresholds(_Field):
+
+    names = ("load1", "load5", "load15", "cpu", "memory", "io")
+
+    def _convert(self, value):
+        value = super()._convert(value)
+        thresholds = []
+        for spec in value.split():
+            name, sep, limit = spec.rpartition("=")
+            if not sep:
+                name = "load1"
+            if name not in self.names:
+                raise CrontabError("invalid load name:%r" % name)
+            try:
+                thresholds.append((name, float(limit)))
+            except ValueError:
+                raise CrontabError("invalid load value:%r" % limit)
+
+        if not thresholds:
+            raise CrontabError("missing load value")
+        return thresholds
+
+
+class CatchUp(_Field):
+    """Convert a catch-up policy to the maximum number of missed runs that are
+       made up for, None means all of them.
+    """
+
+    r_max = re.compile(r"^max:(?P<number>\d+)$")
+
+    def _convert(self, value):
+        value = super()._convert(value).strip()
+        if value == "none":
+            return 0
+        elif value == "once":
+            return 1
+        elif value == "all":
+            return None
+
+        match = self.r_max.match(value)
+        if match is None:
+            raise CrontabError("invalid catchup value:%r" % value)
+
+        number = int(match.group("number"))
+        if number < 1:
+            raise CrontabError("catchup maximum must be at least 1")
+        return number
+
+
 class Boolean(_Field):
 
     def _convert(self, value):
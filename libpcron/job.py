@@ -23,21 +23,29 @@ import os
 import pwd
 import signal
 import socket
+import heapq
+import hashlib
+import itertools
 import collections
 
 from .time import format_time
-from .run import Runner, RunnerError
-from .shared import CrontabError, create_environ
-from .field import String, Boolean, Time, Interval, ListOfStrings
+from .run import Runner, RunnerError, format_usage
+from .shared import CrontabError
+from .field import String, Boolean, Time, Interval, ListOfStrings, Integer, Size, \
+        IoPriority, CpuList, LoadThresholds, CatchUp
 
 
 class Job:
-    """A class that contains a single job from a crontab.ini file.
+    """A single run of a job from a crontab.ini file. Everything that is not
+       specific to the run is looked up in its JobDefinition.
     """
     # pylint:disable=no-member,too-many-instance-attributes
 
     Runner = Runner
 
+    # The user on whose behalf the jobs are run.
+    user = pwd.getpwuid(os.getuid())
+
     _name_regex = r"^\w+(-\w+|\.\w+)*$"
 
     fields = collections.OrderedDict([
@@ -47,18 +55,41 @@ class Job:
 
         ("condition",   String(default=None)),
         ("queue",       String(default=lambda j: j.name, regex=_name_regex)),
+        ("queue_width", Integer(default=1, minimum=1)),
+        ("priority",    Integer(default=0)),
         ("conflict",    String(default="ignore", choices=("ignore", "skip", "kill"))),
         ("warn",        Boolean(default=True)),
+        ("timeout",     Interval(default=None)),
+        ("defer_if_load", LoadThresholds(default=None)),
+        ("deadline",    Interval(default=None)),
 
         ("time",        Time(default=None, schedule=True)),
         ("interval",    Interval(default=None, schedule=True)),
         ("post",        ListOfStrings(default=[], schedule=True)),
+        ("splay",       Interval(default=None)),
+        ("catchup",     CatchUp(default=1)),
+        ("calendar",    ListOfStrings(default=[])),
 
         ("mail",        String(default="error", choices=("never", "always", "error", "output"))),
-        ("mailto",      String(default=pwd.getpwuid(os.getuid()).pw_name)),
+        ("mailto",      String(default=lambda j: j.user.pw_name)),
         ("sendmail",    String(default="/usr/bin/sendmail")),
-        ("username",    String(default=pwd.getpwuid(os.getuid()).pw_name)),
-        ("hostname",    String(default=socket.gethostname()))
+        ("username",    String(default=lambda j: j.user.pw_name)),
+        ("hostname",    String(default=socket.gethostname())),
+
+        ("nice",        Integer(default=None, minimum=-20, maximum=19)),
+        ("ionice",      IoPriority(default=None)),
+        ("cpu_limit",   Integer(default=None, minimum=1)),
+        ("memory_limit", Size(default=None)),
+        ("nofile",      Integer(default=None, minimum=1)),
+        ("cpu_affinity", CpuList(default=None))
+    ])
+
+    # Variables that apply to the crontab as a whole and are only allowed in
+    # the default section.
+    settings = collections.OrderedDict([
+        ("loglevel",    String(default="quiet", choices=("quiet", "info", "debug"))),
+        ("environment", String(default="source", choices=("source", "snapshot"))),
+        ("max_running", Integer(default=0, minimum=0))
     ])
 
     _serial = collections.Counter()
@@ -68,123 +99,97 @@ class Job:
     #
     @classmethod
     def new(cls, name, info, is_parent):
-        job = type(name, (cls,), {})
+        job = JobDefinition(cls)
+
+        # Resolve the values inherited from the parent sections once.
+        info = dict(info)
 
-        info = info.copy()
         has_schedule = False
-        for name, field in job.fields.items():
-            try:
-                value = info.pop(name)
-            except KeyError:
-                setattr(job, name, field.get_default(job))
-            else:
-                setattr(job, name, field(value))
+        for name, field in cls.fields.items():
+            if name in info:
+                try:
+                    setattr(job, name, field(info[name]))
+                except CrontabError as exc:
+                    raise CrontabError(str(exc), option=name)
                 if field.schedule:
                     has_schedule = True
+            else:
+                setattr(job, name, field.get_default(job))
 
         for key in info:
-            raise CrontabError("variable %r not allowed" % key)
+            if key not in cls.fields:
+                raise CrontabError("variable %r not allowed" % key, option=key)
 
         if not has_schedule and not is_parent:
             raise CrontabError("missing scheduling information")
 
-        job.last_run = None
         return job
 
-    def __init__(self, trigger):
+    def __init__(self, definition, trigger, id=None, this_run=None):
+        # pylint:disable=redefined-builtin
+        self.definition = definition
         self.trigger = trigger
-        self.id = "%s-%04d" % (self.name, self._serial[self.name])
-        self._serial[self.name] += 1
+        if id is None:
+            id = "%s-%04d" % (self.name, self._serial[self.name])
+            self._serial[self.name] += 1
+        self.id = id
 
         self.log = self.logger.new(self.id)
 
         # FIXME rename this_run?
-        self.this_run = self.time_provider.now()
-        self.__class__.last_run = self.this_run
+        self.this_run = this_run if this_run is not None else self.time_provider.time()
+        definition.last_run = self.this_run
         self.runner = None
+        self.timed_out = False
+        self.deferred = False
 
-        self.environ = self.create_environ(self.directory, self.name,
-                                           self.id, self.queue)
+        self.environ = dict(self.base_environ, JOB_NAME=self.name, JOB_ID=self.id,
+                            JOB_QUEUE=self.queue)
 
         self.working_dir = os.path.join(self.directory, "jobs", self.name)
         self.username = self.environ["USER"]
 
-    @staticmethod
-    def create_environ(directory, name, id, queue):
-        # Prepare a basic environment for the job.
-        record = pwd.getpwuid(os.getuid())
-        return create_environ(record, PCRONDIR=directory, JOB_NAME=name, JOB_ID=id, JOB_QUEUE=queue)
+    def __getattr__(self, name):
+        if name == "definition":
+            raise AttributeError(name)
+        return getattr(self.definition, name)
 
     def __str__(self):
         return self.id
 
+    def get_checkpoint(self):
+        """Return the information that is needed to restore the job after
+           exec().
+        """
+        checkpoint = {"name": self.name, "id": self.id, "trigger": self.trigger,
+                      "this_run": self.this_run, "timed_out": self.timed_out,
+                      "deferred": self.deferred}
+        if self.runner is not None:
+            checkpoint["runner"] = self.runner.get_checkpoint()
+        return checkpoint
+
     def __repr__(self):
         return "<job-%s %s>" % (self.id, self.next_run)
 
-    #
-    # === Scheduling
-    #
-    @classmethod
-    def init(cls, time_provider, logger, directory, init_code):
-        cls.init_code = init_code
-        cls.time_provider = time_provider
-        cls.logger = logger
-        cls.directory = directory
-
-        if cls.time != "@reboot":
-            if cls.last_run is None:
-                now = cls.time_provider.next_minute()
-            else:
-                now = cls.last_run
-            cls._timestamp_generator = cls.timestamp_generator(now)
-            cls.advance()
-
-    @classmethod
-    def advance(cls):
-        cls.next_trigger, cls.next_run = next(cls._timestamp_generator)
-        log = cls.logger.new(cls.name)
-        log.debug("advance: %s %s", cls.next_trigger, format_time(cls.next_run))
-
-    @classmethod
-    def timestamp_generator(cls, now):
-        infinity = cls.time_provider.infinity
-
-        if cls.time is not None:
-            time_generator = cls.time.timestamp_generator(now)
-        else:
-            time_generator = None
-
-        if cls.interval is not None:
-            interval_generator = cls.interval.timestamp_generator(now)
-        else:
-            interval_generator = None
-
-        time = infinity
-        interval = infinity
-        while True:
-            if time is infinity and time_generator is not None:
-                time = next(time_generator)
-            if interval is infinity and interval_generator is not None:
-                interval = next(interval_generator)
-
-            if time <= interval:
-                yield "time", time
-                time = infinity
-            else:
-                yield "interval", interval
-                interval = infinity
-
     #
     # === Process
     #
     def has_finished(self):
         return self.runner is None or self.runner.has_finished()
 
+    def get_deadline(self):
+        """Return the point in time when the running job process exceeds its
+           timeout.
+        """
+        if self.timeout is None or self.runner is None:
+            return self.time_provider.infinity
+        return self.runner.start_time + self.timeout.seconds
+
     def enqueue(self, queue):
         """Put the job instance in a queue.
         """
         self.log.debug("enqueue (%s)", self.trigger)
-        queue.append(self)
+        queue.push(self)
 
     def start(self):
         """Start the job process.
@@ -195,7 +200,8 @@ class Job:
             self.log.info("execute: %s", self.command)
             try:
                 self.runner = self.Runner(self.working_dir, self.time_provider,
-                                          self.command, self.environ, self.init_code)
+                                          self.command, self.environ, self.init_code,
+                                          self.get_wrapper(), self.user)
             except (OSError, RunnerError) as exc:
                 self.log.warn(str(exc))
                 return False
@@ -220,9 +226,12 @@ class Job:
         assert self.runner.has_finished()
 
         self.runner.finalize()
-        self.log.debug("duration: %s", format_time(self.runner.get_duration()))
+        self.definition.last_usage = self.runner.usage
+        self.log.debug("duration: %s", format_time(self.time_provider.timedelta(
+            seconds=self.runner.get_duration())))
+        self.log.info("resources: %s", format_usage(self.runner.usage))
         if self.next_run < self.time_provider.infinity:
-            self.log.info("next run: %s", self.next_run)
+            self.log.info("next run: %s", format_time(self.next_run))
 
     def close(self):
         if self.runner is None:
@@ -234,7 +243,7 @@ class Job:
         # FIXME Do this asynchronously.
         try:
             with Runner(self.working_dir, self.time_provider, self.condition,
-                        self.environ, self.init_code) as runner:
+                        self.environ, self.init_code, user=self.user) as runner:
                 if runner.wait() == 0:
                     self.log.debug("test %r: true", self.condition)
                     return True
@@ -243,3 +252,223 @@ class Job:
 
         self.log.debug("test %r: false", self.condition)
         return False
+
+
+class JobDefinition:
+    """The values and the scheduling state of a job from a crontab.ini file.
+       Calling it creates a new run of the job.
+    """
+    # pylint:disable=no-member,attribute-defined-outside-init
+
+    __slots__ = ("jobcls", "time_provider", "logger", "directory", "init_code", "base_environ",
+                 "splay_offset", "next_trigger", "next_run", "last_run", "last_usage",
+                 "days_off", "_timestamp_generator") + tuple(Job.fields)
+
+    def __init__(self, jobcls):
+        self.jobcls = jobcls
+        self.last_run = None
+        self.last_usage = None
+        # The Calendar of the days on which the time schedule is suspended.
+        self.days_off = None
+
+    def __call__(self, trigger, id=None, this_run=None):
+        # pylint:disable=redefined-builtin
+        return self.jobcls(self, trigger, id, this_run)
+
+    def restore(self, checkpoint):
+        """Recreate a run of the job from a checkpoint. If the job was
+           running, its process is taken over.
+        """
+        job = self(checkpoint["trigger"], checkpoint["id"], checkpoint["this_run"])
+        job.timed_out = checkpoint["timed_out"]
+        job.deferred = checkpoint["deferred"]
+        if "runner" in checkpoint:
+            job.runner = job.Runner.restore(job.working_dir, self.time_provider, self.command,
+                                            checkpoint["runner"])
+        return job
+
+    def __repr__(self):
+        return "<job %s>" % self.name
+
+    @property
+    def user(self):
+        return self.jobcls.user
+
+    #
+    # === Scheduling
+    #
+    def init(self, time_provider, logger, directory, init_code, base_environ):
+        self.time_provider = time_provider
+        self.logger = logger
+        self.directory = directory
+        self.set_environment(init_code, base_environ)
+        self.splay_offset = self.get_splay_offset()
+
+        if self.time != "@reboot":
+            if self.last_run is None:
+                now = self.time_provider.next_tick(self.get_resolution())
+            else:
+                now = self.last_run
+            self.reschedule(now)
+
+    def set_environment(self, init_code, base_environ):
+        self.init_code = init_code
+        self.base_environ = base_environ
+
+    def reschedule(self, now, interval_start=None):
+        """Restart the schedule at a particular point in time. The interval
+           schedule may start at a different point in time.
+        """
+        self._timestamp_generator = self.timestamp_generator(now, interval_start)
+        self.advance()
+
+    def count_runs(self, start, stop):
+        """Return the number of runs that are scheduled between start
+           (inclusive) and stop (exclusive).
+        """
+        count = 0
+        if self.time is not None:
+            count += self.time.count(start - self.splay_offset, stop - self.splay_offset,
+                                     self.days_off)
+        if self.interval is not None:
+            count += -((start - stop) // self.interval.seconds)
+        return count
+
+    def get_resolution(self):
+        """Return the granularity of the schedule in seconds, which is one
+           minute unless seconds are used.
+        """
+        resolution = 60
+        if self.time is not None:
+            resolution = min(resolution, self.time.resolution)
+            if self.splay is not None:
+                resolution = min(resolution, self.splay.resolution)
+        if self.interval is not None:
+            resolution = min(resolution, self.interval.resolution)
+        return resolution
+
+    def advance(self):
+        self.next_trigger, self.next_run = next(self._timestamp_generator)
+        log = self.logger.new(self.name)
+        log.debug("advance: %s %s", self.next_trigger, format_time(self.next_run))
+
+    def get_splay_offset(self):
+        """Return the offset by which the time schedule of the job is shifted
+           in order to spread jobs with the same schedule. The offset is
+           derived from the user and job name, so that it remains the same
+           across restarts. It is a multiple of one minute unless the splay
+           is given in seconds.
+        """
+        if self.splay is None:
+            return 0
+
+        unit = self.splay.resolution
+        digest = hashlib.sha1(("%s/%s" % (self.username, self.name)).encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "big") % (self.splay.seconds // unit) * unit
+
+    def timestamp_generator(self, now, interval_start=None):
+        infinity = self.time_provider.infinity
+
+        if self.time is not None:
+            offset = self.splay_offset
+            time_generator = (t + offset for t in self.time.timestamp_generator(now - offset,
+                                                                                self.days_off))
+        else:
+            time_generator = None
+
+        if self.interval is not None:
+            interval_generator = self.interval.timestamp_generator(
+                now if interval_start is None else interval_start)
+        else:
+            interval_generator = None
+
+        time = infinity
+        interval = infinity
+        while True:
+            if time == infinity and time_generator is not None:
+                time = next(time_generator, infinity)
+            if interval == infinity and interval_generator is not None:
+                interval = next(interval_generator)
+
+            if time <= interval:
+                yield "time", time
+                time = infinity
+            else:
+                yield "interval", interval
+                interval = infinity
+
+    def get_wrapper(self):
+        """Return the command line prefix that applies the resource limits
+           and scheduling priorities of the job. Each of the tools sets up
+           its part and then executes the next one, so everything is in
+           place before the command starts.
+        """
+        wrapper = []
+
+        limits = [("--cpu", self.cpu_limit), ("--as", self.memory_limit), ("--nofile", self.nofile)]
+        limits = ["%s=%d" % (option, value) for option, value in limits if value is not None]
+        if limits:
+            wrapper += ["prlimit"] + limits
+
+        if self.nice is not None:
+            wrapper += ["nice", "-n", str(self.nice)]
+
+        if self.ionice is not None:
+            ioclass, level = self.ionice
+            wrapper += ["ionice", "-c", str(ioclass)]
+            if level is not None:
+                wrapper += ["-n", str(level)]
+
+        if self.cpu_affinity is not None:
+            wrapper += ["taskset", "-c", self.cpu_affinity]
+
+        return wrapper
+
+
+class JobQueue:
+    """The jobs that wait in a queue, in the order in which they are started:
+       jobs with a higher priority first, jobs with the same priority in the
+       order in which they were scheduled. To prevent starvation, a job gains
+       one priority level for every AGING seconds it waits. As all waiting
+       jobs age at the same rate, their order never changes, and a heap
+       ordered by this_run - priority * AGING does the job.
+    """
+
+    AGING = 600
+
+    def __init__(self):
+        self.heap = []
+        self.serial = itertools.count()
+
+    def push(self, job):
+        heapq.heappush(self.heap, (job.this_run - job.priority * self.AGING, next(self.serial), job))
+
+    def peek(self):
+        """Return the job that is next in line.
+        """
+        return self.heap[0][2]
+
+    def get_key(self):
+        """Return the sort key of the job that is next in line, so that the
+           queues themselves can be ordered.
+        """
+        return self.heap[0][:2]
+
+    def remove(self, job):
+        if self.heap[0][2] is job:
+            heapq.heappop(self.heap)
+            return
+
+        for index, (_, _, other) in enumerate(self.heap):
+            if other is job:
+                self.heap[index] = self.heap[-1]
+                self.heap.pop()
+                heapq.heapify(self.heap)
+                return
+        raise ValueError("job %s is not in the queue" % (job,))
+
+    def __iter__(self):
+        return (job for _, _, job in sorted(self.heap))
+
+    def __len__(self):
+        return len(self.heap)
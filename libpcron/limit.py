@@ -0,0 +1,273 @@
+# -----------------------------------------------------------------------
+#
+# pcron - a periodic cron-like job scheduler.
+# Copyright (C) 2009-2016 Lars Gustäbel <lars@gustaebel.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+# -----------------------------------------------------------------------
+
+import os
+import time
+import fcntl
+
+SLOT_PREFIX = "slot."
+USER_PREFIX = "user."
+
+
+def create_slots(directory, count):
+    """Prepare a slot directory for count jobs that all pcron instances on
+       the host share.
+    """
+    os.makedirs(directory, exist_ok=True)
+    os.chmod(directory, 0o1777)
+
+    for name in os.listdir(directory):
+        if name.startswith(SLOT_PREFIX):
+            os.remove(os.path.join(directory, name))
+
+    for i in range(count):
+        path = os.path.join(directory, "%s%d" % (SLOT_PREFIX, i))
+        with open(path, "w"):
+            pass
+        os.chmod(path, 0o444)
+
+
+class NullLimiter:
+    """A limiter that imposes no limit at all.
+    """
+
+    def acquire(self, key):
+        # pylint:disable=unused-argument
+        return True
+
+    def release(self, key):
+        pass
+
+    def set_active(self, active):
+        pass
+
+    def get_usage(self):
+        return None
+
+
+class SlotLimiter(NullLimiter):
+    """Limit the number of jobs that run at the same time across all pcron
+       instances on the host. The slot directory is prepared by pcrond(1) and
+       contains one file per slot. A job takes a slot by holding a lock on
+       one of these files while it is running.
+
+       To share the slots fairly between users, every pcron instance that has
+       jobs running or waiting holds a lock on a user file of its own. No
+       instance may take more than its share of the slots as long as other
+       instances are competing for them.
+    """
+
+    # The number of seconds the user file may stay locked by others before
+    # we give up on the limiter.
+    REGISTER_TIMEOUT = 60
+
+    def __init__(self, directory, name, log):
+        self.directory = directory
+        self.user_path = os.path.join(self.directory, USER_PREFIX + name)
+        self.log = log
+
+        self.slots = {}
+        self.user_fd = None
+        self.refused_since = None
+        self.available = True
+
+    def list_files(self, prefix):
+        return sorted(os.path.join(self.directory, name)
+                      for name in os.listdir(self.directory) if name.startswith(prefix))
+
+    def set_available(self, available, exc=None):
+        if available != self.available:
+            if available:
+                self.log.info("host slot limiter in %s is available", self.directory)
+            else:
+                self.log.warn("host slot limiter in %s is unavailable: %s", self.directory, exc)
+            self.available = available
+
+    def acquire(self, key):
+        """Try to take a slot for key and return True on success. If the
+           slot directory is unusable, there is no limit.
+        """
+        try:
+            paths = self.list_files(SLOT_PREFIX)
+            if not paths:
+                raise FileNotFoundError("no slots")
+            registered = self.register()
+            users = self.count_active_users()
+        except OSError as exc:
+            self.set_available(False, exc)
+            return True
+
+        self.set_available(True)
+
+        if not registered:
+            # Try again with the next iteration.
+            return False
+
+        # The share is rounded up, so that no slot remains unused. The locks
+        # on the slot files limit the total anyway.
+        if len(self.slots) >= -(-len(paths) // users):
+            return False
+
+        for path in paths:
+            try:
+                fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+            except OSError:
+                continue
+
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                continue
+
+            self.slots[key] = fd
+            return True
+
+        return False
+
+    def release(self, key):
+        fd = self.slots.pop(key, None)
+        if fd is not None:
+            os.close(fd)
+
+    def register(self):
+        """Mark this instance as one that competes for slots. Return False if
+           the user file is briefly locked by another instance that counts
+           the active users. A user file that belongs to someone else or
+           that stays locked makes the limiter unusable.
+        """
+        if self.user_fd is None:
+            fd = os.open(self.user_path, os.O_RDONLY | os.O_CREAT | os.O_NOFOLLOW | os.O_CLOEXEC,
+                         0o444)
+            try:
+                if os.fstat(fd).st_uid != os.geteuid():
+                    raise PermissionError("%s belongs to another user" % self.user_path)
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                now = time.monotonic()
+                if self.refused_since is None:
+                    self.refused_since = now
+                elif now - self.refused_since >= self.REGISTER_TIMEOUT:
+                    raise BlockingIOError("%s stays locked" % self.user_path)
+                return False
+            except OSError:
+                os.close(fd)
+                raise
+            self.user_fd = fd
+            self.refused_since = None
+        return True
+
+    def set_active(self, active):
+        if active:
+            try:
+                self.register()
+            except OSError as exc:
+                self.set_available(False, exc)
+
+        elif self.user_fd is not None:
+            os.close(self.user_fd)
+            self.user_fd = None
+
+    def count_active_users(self):
+        count = 0
+        for path in self.list_files(USER_PREFIX):
+            if path == self.user_path:
+                count += 1
+                continue
+
+            try:
+                fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+            except OSError:
+                continue
+
+            try:
+                fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except OSError:
+                # The file is locked by an active instance.
+                count += 1
+            finally:
+                os.close(fd)
+
+        return max(1, count)
+
+    def get_usage(self):
+        try:
+            return len(self.slots), len(self.list_files(SLOT_PREFIX))
+        except OSError:
+            return None
+
+
+class LoadMonitor:
+    """Provide the system load averages and the pressure stall information
+       of the kernel. The values are read at most once between two calls to
+       reset(), so that checking a lot of jobs remains cheap.
+    """
+
+    PRESSURE = ("cpu", "memory", "io")
+
+    def __init__(self, proc="/proc"):
+        self.proc = proc
+        self.values = None
+
+    def reset(self):
+        self.values = None
+
+    def get_values(self):
+        if self.values is None:
+            self.values = self.read()
+        return self.values
+
+    def read(self):
+        values = {}
+
+        try:
+            with open(os.path.join(self.proc, "loadavg")) as fobj:
+                fields = fobj.read().split()
+            values["load1"], values["load5"], values["load15"] = [float(f) for f in fields[:3]]
+        except (OSError, ValueError):
+            pass
+
+        for name in self.PRESSURE:
+            try:
+                with open(os.path.join(self.proc, "pressure", name)) as fobj:
+                    for line in fobj:
+                        kind, _, rest = line.partition(" ")
+                        if kind == "some":
+                            fields = dict(field.split("=", 1) for field in rest.split())
+                            values[name] = float(fields["avg10"])
+                            break
+            except (OSError, ValueError, KeyError):
+                pass
+
+        return values
+
+    def get_exceeded(self, thresholds):
+        """Return a list of the thresholds that are currently exceeded. Values
+           that are not available on this system are never exceeded.
+        """
+        values = self.get_values()
+        exceeded = []
+        for name, limit in thresholds:
+            value = values.get(name)
+            if value is not None and value > limit:
+                exceeded.append("%s %.2f > %g" % (name, value, limit))
+        return exceeded
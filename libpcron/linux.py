@@ -0,0 +1,228 @@
+# -----------------------------------------------------------------------
+#
+# pcron - a periodic cron-like job scheduler.
+# Copyright (C) 2009-2016 Lars Gustäbel <lars@gustaebel.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+# -----------------------------------------------------------------------
+
+# Interfaces to Linux-specific system calls that are not available from the
+# os module. They raise OSError on systems that do not support them, so that
+# the callers can fall back to portable methods.
+
+import os
+import errno
+import struct
+import ctypes
+import ctypes.util
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+CLOCK_REALTIME = 0
+TFD_TIMER_ABSTIME = 1
+TFD_TIMER_CANCEL_ON_SET = 2
+
+_libc = None
+
+
+def get_libc():
+    global _libc
+    if _libc is None:
+        name = ctypes.util.find_library("c")
+        if name is None:
+            raise OSError(errno.ENOSYS, "libc not found")
+        _libc = ctypes.CDLL(name, use_errno=True)
+    return _libc
+
+
+def get_function(name):
+    try:
+        return getattr(get_libc(), name)
+    except AttributeError:
+        raise OSError(errno.ENOSYS, "%s() is not supported" % name)
+
+
+def check(result):
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return result
+
+
+def get_process_stat(pid):
+    """Return the parent pid and the start time (in clock ticks after boot)
+       of a process from /proc/<pid>/stat. The start time and the pid
+       together identify a process, even if the pid has been reused.
+    """
+    with open("/proc/%d/stat" % pid, "rb") as fobj:
+        stat = fobj.read()
+
+    # The command name is in parentheses and may contain anything.
+    fields = stat[stat.rindex(b")") + 2:].split()
+    return int(fields[1]), int(fields[19])
+
+
+class timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+class itimerspec(ctypes.Structure):
+    _fields_ = [("it_interval", timespec), ("it_value", timespec)]
+
+
+class TimerFD:
+    """A minimal interface to timerfd(2) for one-shot timers that expire at
+       an absolute point in time of the CLOCK_REALTIME clock.
+    """
+
+    def __init__(self):
+        self.fd = check(get_function("timerfd_create")(CLOCK_REALTIME,
+                                                       os.O_NONBLOCK | os.O_CLOEXEC))
+
+    def fileno(self):
+        return self.fd
+
+    def set(self, deadline):
+        """Arm the timer to expire at deadline (in seconds since the epoch).
+           If the clock is set in the meantime, the timer is cancelled.
+        """
+        value = itimerspec()
+        value.it_value.tv_sec = int(deadline)
+        value.it_value.tv_nsec = int((deadline - int(deadline)) * 1000000000)
+        check(get_function("timerfd_settime")(self.fd, TFD_TIMER_ABSTIME | TFD_TIMER_CANCEL_ON_SET,
+                                              ctypes.byref(value), None))
+
+    def read(self):
+        """Return True if the timer has expired, False if it has been
+           cancelled because the clock was set and None if neither has
+           happened yet.
+        """
+        try:
+            os.read(self.fd, 8)
+        except BlockingIOError:
+            return None
+        except OSError as exc:
+            if exc.errno == errno.ECANCELED:
+                return False
+            raise
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Inotify:
+    """A minimal interface to the inotify(7) API.
+    """
+
+    event = struct.Struct("iIII")
+
+    def __init__(self):
+        self.fd = check(get_function("inotify_init1")(os.O_NONBLOCK | os.O_CLOEXEC))
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        return check(get_function("inotify_add_watch")(self.fd, os.fsencode(path), mask))
+
+    def rm_watch(self, wd):
+        check(get_function("inotify_rm_watch")(self.fd, wd))
+
+    def read(self):
+        """Return a list of (wd, mask, cookie, name) tuples for all events that
+           are available.
+        """
+        events = []
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+
+            offset = 0
+            while offset < len(buf):
+                wd, mask, cookie, length = self.event.unpack_from(buf, offset)
+                offset += self.event.size
+                name = buf[offset:offset + length].rstrip(b"\0")
+                offset += length
+                events.append((wd, mask, cookie, os.fsdecode(name)))
+
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SignalFD:
+    """A minimal interface to signalfd(2). The signals must be blocked with
+       signal.pthread_sigmask() beforehand.
+    """
+
+    # The size of struct signalfd_siginfo and struct sigset_t.
+    siginfo_size = 128
+    sigset_size = 128
+
+    def __init__(self, signals):
+        mask = ctypes.create_string_buffer(self.sigset_size)
+        check(get_function("sigemptyset")(mask))
+        for signum in signals:
+            check(get_function("sigaddset")(mask, int(signum)))
+        self.fd = check(get_function("signalfd")(-1, mask, os.O_NONBLOCK | os.O_CLOEXEC))
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        """Return the number of the next pending signal or None.
+        """
+        try:
+            buf = os.read(self.fd, self.siginfo_size)
+        except BlockingIOError:
+            return None
+        return struct.unpack_from("I", buf)[0]
+
+    def close(self):
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
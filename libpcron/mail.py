@@ -21,12 +21,15 @@
 
 import sys
 import os
+import errno
+import shutil
 import signal
 import subprocess
 import email
 import locale
 
 from .time import format_time
+from .run import format_usage, get_popen_options
 from .shared import EXC_PREFIX
 
 
@@ -39,6 +42,7 @@ From: pcron <%(username)s>
 To: %(mailto)s
 Content-Type: text/plain; charset="%(encoding)s"
 Pcron-Status: INFO
+Pcron-Usage: %(usage)s
 Subject: pcron: %(username)s@%(hostname)s %(timestamp)s %(job)s
 
 """
@@ -48,6 +52,7 @@ From: pcron <%(username)s>
 To: %(mailto)s
 Content-Type: text/plain; charset="%(encoding)s"
 Pcron-Status: ERROR
+Pcron-Usage: %(usage)s
 Subject: pcron: ERROR: %(username)s@%(hostname)s %(timestamp)s %(job)s
 
 Job %(job)s exited with error code %(exitcode)s.
@@ -59,12 +64,25 @@ From: pcron <%(username)s>
 To: %(mailto)s
 Content-Type: text/plain; charset="%(encoding)s"
 Pcron-Status: KILLED
+Pcron-Usage: %(usage)s
 Subject: pcron: KILLED! %(username)s@%(hostname)s %(timestamp)s %(job)s
 
 Job %(job)s was killed by signal %(signal)s.
 
 """
 
+MAIL_TIMEOUT = """\
+From: pcron <%(username)s>
+To: %(mailto)s
+Content-Type: text/plain; charset="%(encoding)s"
+Pcron-Status: TIMEOUT
+Pcron-Usage: %(usage)s
+Subject: pcron: TIMEOUT! %(username)s@%(hostname)s %(timestamp)s %(job)s
+
+Job %(job)s was killed because it exceeded its timeout of %(timeout)s.
+
+"""
+
 MAIL_SKIP_WAITING = """\
 From: pcron <%(username)s>
 To: %(mailto)s
@@ -128,7 +146,9 @@ class Mailer:
             # Prepare the email message's text.
             returncode = job.runner.returncode
 
-            if returncode == 0:
+            if job.timed_out:
+                text = MAIL_TIMEOUT
+            elif returncode == 0:
                 text = MAIL_INFO
             elif returncode > 0:
                 text = MAIL_ERROR
@@ -154,9 +174,11 @@ class Mailer:
         pid = -1
         exitcode = -1
         signal = "NONE"
+        usage = None
 
         if runner:
             pid = runner.get_pid()
+            usage = runner.usage
 
             if runner.returncode is not None:
                 exitcode = runner.returncode
@@ -170,16 +192,18 @@ class Mailer:
             "hostname": job.hostname,
             "timestamp": format_time(job.this_run),
             "command":  job.command,
+            "timeout":  job.timeout,
             "exitcode": exitcode,
             "pid":      pid,
             "signal":   signal,
+            "usage":    format_usage(usage),
             "encoding": self.encoding
         }
 
         self.send(job.sendmail, job.mailto, job.working_dir, job.environ, text,
-                runner.output if runner is not None else None)
+                runner.output if runner is not None else None, job.user)
 
-    def send(self, sendmail, mailto, directory, environ, text, output):
+    def send(self, sendmail, mailto, directory, environ, text, output, user=None):
         self.log.debug("send mail to %s", mailto)
 
         if "{}" in sendmail:
@@ -192,23 +216,28 @@ class Mailer:
             try:
                 process = subprocess.Popen(
                         command, shell=True, cwd=directory, env=environ,
-                        stdin=subprocess.PIPE, stdout=fileobj, stderr=subprocess.STDOUT)
+                        stdin=subprocess.PIPE, stdout=fileobj, stderr=subprocess.STDOUT,
+                        **get_popen_options(user))
             except OSError as exc:
                 self.log.error("%r failed: %s", command, exc)
                 log_error = True
             else:
-                # Write boilerplate.
-                process.stdin.write(text.encode(self.encoding))
-
-                # Write job logfile.
-                if output is not None:
-                    while process.poll() is None:
-                        buf = output.read(512)
-                        if not buf:
-                            break
-                        process.stdin.write(buf)
-
-                process.stdin.close()
+                try:
+                    # Write boilerplate.
+                    process.stdin.write(text.encode(self.encoding))
+                    process.stdin.flush()
+
+                    # Write job logfile.
+                    if output is not None:
+                        self.copy_output(output, process.stdin)
+                except BrokenPipeError:
+                    # sendmail exited prematurely, its exit code will tell.
+                    pass
+
+                try:
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass
 
                 if process.wait() != 0:
                     self.log.error("%r failed with exit code %s", command, process.wait())
@@ -221,3 +250,32 @@ class Mailer:
                 for line in fileobj:
                     self.log.error(EXC_PREFIX + line)
 
+    def copy_output(self, output, stdin):
+        """Copy the job output to sendmail's stdin. We use os.sendfile() so that
+           the data is passed from the output file to the pipe inside the
+           kernel, and fall back to a regular copy where this is not
+           supported.
+        """
+        in_fd = output.fileno()
+        out_fd = stdin.fileno()
+        offset = output.tell()
+        size = os.fstat(in_fd).st_size
+
+        try:
+            while offset < size:
+                sent = os.sendfile(out_fd, in_fd, offset, size - offset)
+                if not sent:
+                    break
+                offset += sent
+            return
+
+        except AttributeError:
+            pass
+
+        except OSError as exc:
+            if exc.errno not in (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK, errno.EOPNOTSUPP):
+                raise
+
+        output.seek(offset)
+        shutil.copyfileobj(output, stdin)
+        stdin.flush()
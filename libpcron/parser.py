@@ -19,90 +19,195 @@
 #
 # -----------------------------------------------------------------------
 
-import configparser
+import re
+import sys
 import collections
 
-from .shared import CrontabError, CrontabEmptyError, Logger
+from .shared import CrontabError, CrontabEmptyError
+from .calendars import Calendar, resolve_calendars
 
 
-def extract_loglevel_from_crontab(path):
-    parser = configparser.RawConfigParser(default_section="default")
-    try:
-        parser.read([path])
-    except configparser.DuplicateSectionError:
-        pass
+def get_default_settings(jobcls):
+    return dict((name, field.get_default(None)) for name, field in jobcls.settings.items())
 
-    value = parser.defaults().get("loglevel")
-    if value is None:
-        return Logger.WARN
 
-    else:
-        try:
-            return Logger.levels[value]
-        except KeyError:
-            raise CrontabError("invalid loglevel value:%r" % value)
+class CrontabParser:
+    """Read a crontab file in a single pass. The syntax is the INI dialect of
+       the configparser module: sections, options with values separated by
+       `:' or `=', full-line comments starting with `#' or `;', and values
+       that are continued on indented lines. A section inherits the options
+       of its parent section (or the default section) by way of a ChainMap,
+       so nothing is copied.
+    """
 
+    r_section = re.compile(r"\[(?P<header>.+)\]")
+    r_option = re.compile(r"(?P<option>.*?)\s*[=:]\s*(?P<value>.*)$")
 
-class CrontabParser:
+    comment_prefixes = ("#", ";")
 
-    def __init__(self, path, jobcls):
+    def __init__(self, path, jobcls, calendars=None):
         self.path = path
         self.jobcls = jobcls
+        self.calendars = calendars
+        self.calendar_cache = {}
+        self.settings = get_default_settings(jobcls)
 
-        self.parser = configparser.ConfigParser(interpolation=None)
+        # Map section names to the line number of the section header, the
+        # options and the line numbers of the options.
+        self.sections = collections.OrderedDict()
+        self.parents = set()
 
-    def parse(self):
-        try:
-            with open(self.path) as fobj:
-                self.parser.read_file(fobj)
-        except configparser.DuplicateSectionError as exc:
-            raise CrontabError("duplicate job %s" % exc.section)
-        except configparser.DuplicateOptionError as exc:
-            raise CrontabError("duplicate option %s in job %s" % (exc.option, exc.section))
-
-        if not self.parser.sections():
-            raise CrontabEmptyError("crontab is empty")
+    def error(self, lineno, message):
+        return CrontabError("%s:%d: %s" % (self.path, lineno, message))
 
-        parents = set()
-        infos = collections.OrderedDict()
-        for name in self.parser.sections():
-            try:
-                parent, _ = name.rsplit(".", 1)
-            except ValueError:
-                info = infos.get("default", {}).copy()
-            else:
-                if parent in infos:
-                    info = infos[parent].copy()
-                    parents.add(parent)
-                else:
-                    raise CrontabError("missing parent job %s" % parent)
-
-            for option in self.parser.options(name):
-                if option == "loglevel":
-                    # FIXME ATM loglevel option is global only.
-                    continue
-                info[option] = self.parser.get(name, option)
+    def parse(self):
+        with open(self.path) as fobj:
+            self.read(fobj)
 
-            info["name"] = name
-            infos[name] = info
+        if not self.sections:
+            raise CrontabEmptyError("crontab is empty")
 
-        try:
-            infos.pop("default")
-        except KeyError:
-            pass
+        self.sections.pop("default", None)
 
         startup = collections.OrderedDict()
         jobs = collections.OrderedDict()
-        for name, info in infos.items():
-            job = self.jobcls.new(name, info, name in parents)
+        for name, (lineno, info, lines) in self.sections.items():
+            try:
+                job = self.jobcls.new(name, info, name in self.parents)
+            except CrontabError as exc:
+                raise self.error(lines.get(exc.option, lineno), exc)
+
+            if self.calendars is not None and job.calendar:
+                self.set_calendar(job, lines["calendar"])
+
             if info.get("time") == "@reboot":
                 startup[name] = job
             else:
                 jobs[name] = job
 
             if job.active:
-                posts = set(job.post) - set(infos.keys())
+                posts = [post for post in job.post if post not in self.sections]
                 if posts:
-                    raise CrontabError("post job %s not found" % sorted(posts)[0])
+                    raise self.error(lines["post"], "post job %s not found" % sorted(posts)[0])
 
         return startup, jobs
+
+    def set_calendar(self, job, lineno):
+        for name in job.calendar:
+            if name not in self.calendars:
+                raise self.error(lineno, "calendar %s not found" % name)
+        job.days_off = resolve_calendars(self.calendars, job.calendar, self.calendar_cache)
+
+    def read(self, fobj):
+        name = None
+        option = None
+        values = lines = None
+        indent = sys.maxsize
+        blank = 0
+
+        for lineno, line in enumerate(fobj, 1):
+            value = line.strip()
+
+            if not value:
+                # Empty lines may be part of a multi-line value.
+                blank += 1
+                continue
+
+            if value.startswith(self.comment_prefixes):
+                continue
+
+            level = len(line) - len(line.lstrip())
+            if option is not None and level > indent:
+                values[option] += "\n" * (blank + 1) + value
+                blank = 0
+                continue
+
+            option = None
+            blank = 0
+            indent = level
+
+            match = self.r_section.match(value)
+            if match is not None:
+                name = match.group("header")
+                values, lines = self.add_section(lineno, name)
+                continue
+
+            if name is None:
+                raise self.error(lineno, "missing section header")
+
+            match = self.r_option.match(value)
+            if match is None:
+                raise self.error(lineno, "syntax error: %r" % value)
+
+            key = match.group("option").lower()
+            if not key:
+                raise self.error(lineno, "missing variable name")
+
+            if key in lines.maps[0]:
+                raise self.error(lineno, "duplicate option %s in job %s" % (key, name))
+            lines[key] = lineno
+
+            if key in self.jobcls.settings:
+                if key == "loglevel" and name != "default":
+                    # FIXME ATM loglevel option is global only.
+                    continue
+                if name != "default":
+                    raise self.error(lineno, "variable %r is only allowed in the default section" % key)
+                try:
+                    self.settings[key] = self.jobcls.settings[key](match.group("value"))
+                except CrontabError as exc:
+                    raise self.error(lineno, exc)
+                continue
+
+            if key != "name":
+                values[key] = match.group("value")
+                option = key
+
+    def add_section(self, lineno, name):
+        if name in self.sections:
+            raise self.error(lineno, "duplicate job %s" % name)
+
+        try:
+            parent, _ = name.rsplit(".", 1)
+        except ValueError:
+            parent = "default"
+        else:
+            if parent not in self.sections:
+                raise self.error(lineno, "missing parent job %s" % parent)
+            self.parents.add(parent)
+
+        if parent in self.sections:
+            _, values, lines = self.sections[parent]
+            values, lines = values.new_child(), lines.new_child()
+        else:
+            values, lines = collections.ChainMap(), collections.ChainMap()
+
+        values["name"] = name
+        self.sections[name] = (lineno, values, lines)
+        return values, lines
+
+
+class CalendarParser(CrontabParser):
+    """Read a calendars.ini file, which has the same syntax as the crontab.
+       Each section is a calendar.
+    """
+
+    def __init__(self, path):
+        super().__init__(path, Calendar)
+
+    def parse(self):
+        with open(self.path) as fobj:
+            self.read(fobj)
+
+        self.sections.pop("default", None)
+
+        calendars = collections.OrderedDict()
+        for name, (lineno, info, lines) in self.sections.items():
+            for key in info:
+                if key not in ("name", "dates"):
+                    raise self.error(lines[key], "variable %r not allowed" % key)
+            try:
+                calendars[name] = Calendar.parse(name, info.get("dates", ""))
+            except CrontabError as exc:
+                raise self.error(lines.get("dates", lineno), exc)
+        return calendars
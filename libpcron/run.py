@@ -21,15 +21,22 @@
 
 # FIXME Rename to process.Process.
 
+import sys
 import os
 import time
+import signal
+import json
 import subprocess
 import tempfile
 import shutil
 import hashlib
+# os.wait4() needs the resource module, import it in advance, because we might
+# not be able to do that later when acting on behalf of another user.
+import resource
 
 from . import SUPPORTED_SHELLS
 from .time import IntervalSpec
+from .linux import get_process_stat
 
 
 class RunnerError(Exception):
@@ -44,10 +51,145 @@ set +ea
 %s
 """
 
+# Dump the environment after the init_code has been executed. We let the
+# Python interpreter do that, so that we don't have to worry about quoting.
+SNAPSHOT_CODE = """exec "%s" -c 'import os, sys, json; json.dump(dict(os.environ), sys.stdout)'"""
+
+# The number of seconds the init_code may take for a snapshot.
+SNAPSHOT_TIMEOUT = 10
+
+# Variables that are maintained by the shell itself.
+SHELL_VARIABLES = set(["PWD", "OLDPWD", "SHLVL", "_"])
+
+
+# The limit on open files that child processes get if we have raised our own,
+# see raise_nofile_limit().
+child_nofile_limit = None
+
+
+def raise_nofile_limit():
+    """Raise the soft limit on open files to the hard limit and return it.
+       This is for a process that hosts the schedulers of many users. The
+       child processes are started with the original limit.
+    """
+    global child_nofile_limit  # pylint:disable=global-statement
+
+    limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+    soft, hard = limit
+    if soft != hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            return soft
+        if child_nofile_limit is None:
+            child_nofile_limit = limit
+    return hard
+
+
+def restore_nofile_limit():
+    resource.setrlimit(resource.RLIMIT_NOFILE, child_nofile_limit)
+
+
+def get_popen_options(user):
+    """Return the keyword arguments for subprocess.Popen() that start a
+       process with the real user and group ids of user. This is only
+       necessary if we act on behalf of another user (see Credentials),
+       otherwise the process inherits our ids.
+    """
+    options = {}
+    if child_nofile_limit is not None:
+        options["preexec_fn"] = restore_nofile_limit
+    if user is not None and os.getuid() != user.pw_uid:
+        options.update(user=user.pw_uid, group=user.pw_gid)
+    return options
+
+
+def snapshot_environ(directory, environ, init_code, user=None, timeout=SNAPSHOT_TIMEOUT):
+    """Execute the init_code once and return the environment that results
+       from it, so that it can be used for starting commands directly. The
+       init_code is killed if it takes longer than timeout seconds.
+    """
+    shell = environ["SHELL"]
+    if os.path.basename(shell) not in SUPPORTED_SHELLS:
+        raise RunnerError("unsupported shell %s" % shell)
+
+    # Start a new session so that we can kill the processes that the
+    # init_code may have left behind together with the shell.
+    process = subprocess.Popen([shell, "-c", SHELL_CODE % (init_code, SNAPSHOT_CODE % sys.executable)],
+                               cwd=directory, env=environ, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, start_new_session=True,
+                               **get_popen_options(user))
+    try:
+        stdout, stderr = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        process.communicate()
+        raise RunnerError("environment did not finish within %d seconds" % timeout)
+    if process.returncode != 0:
+        raise RunnerError("environment exited with error code %s: %s" % \
+                (process.returncode, stderr.decode(errors="replace").strip()))
+
+    try:
+        snapshot = json.loads(stdout.decode())
+    except ValueError as exc:
+        raise RunnerError("unable to read environment: %s" % exc)
+
+    for name in SHELL_VARIABLES:
+        snapshot.pop(name, None)
+    return snapshot
+
+
+def format_usage(usage):
+    """Return a one-line summary of a resource.struct_rusage object.
+    """
+    if usage is None:
+        return "unknown"
+
+    return "utime=%.3fs stime=%.3fs maxrss=%dkB inblock=%d oublock=%d nvcsw=%d nivcsw=%d" % \
+            (usage.ru_utime, usage.ru_stime, usage.ru_maxrss, usage.ru_inblock,
+             usage.ru_oublock, usage.ru_nvcsw, usage.ru_nivcsw)
+
+
+class AdoptedProcess:
+    """A replacement for the subprocess.Popen object of a process that has
+       been started by the pcron process that we replaced with exec().
+    """
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.returncode = None
+
+    def poll(self):
+        try:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+        except ChildProcessError:
+            # The exit status is lost.
+            self.returncode = 255
+        else:
+            if pid != 0:
+                self.returncode = os.waitstatus_to_exitcode(status)
+        return self.returncode
+
+    def send_signal(self, signum):
+        try:
+            os.kill(self.pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
 
 class Runner:
 
-    def __init__(self, working_dir, time_provider, command, environ, init_code):
+    def __init__(self, working_dir, time_provider, command, environ, init_code, wrapper=(),
+                 user=None):
         self.working_dir = working_dir
         self.time_provider = time_provider
         self.command = command
@@ -69,8 +211,9 @@ class Runner:
             # Write the initialization code and the command to the script file.
             fobj.write(SHELL_CODE % (self.init_code, self.command))
 
-        self.start_time = self.time_provider.now()
+        self.start_time = self.time_provider.time()
         self.stop_time = None
+        self.usage = None
 
         shell = self.environ["SHELL"]
 
@@ -78,16 +221,78 @@ class Runner:
         if os.path.basename(shell) not in SUPPORTED_SHELLS:
             raise RunnerError("unsupported shell %s" % shell)
 
-        # Start the command in the user's shell.
+        # Start the command in the user's shell, prefixed by the wrapper
+        # commands that apply resource limits.
         self.output = open(self.output_path, "w+b")
-        self.process = subprocess.Popen([shell, self.script_path], cwd=self.working_dir,
-                                        env=self.environ, stdout=self.output, stderr=subprocess.STDOUT)
+        self.process = subprocess.Popen(list(wrapper) + [shell, self.script_path],
+                                        cwd=self.working_dir, env=self.environ,
+                                        stdout=self.output, stderr=subprocess.STDOUT,
+                                        **get_popen_options(user))
+
+    def get_checkpoint(self):
+        """Return the information that is needed to take over the running
+           process after exec().
+        """
+        _, proc_start = get_process_stat(self.process.pid)
+        return {"pid": self.process.pid, "start_time": self.start_time, "proc_start": proc_start}
+
+    @classmethod
+    def restore(cls, working_dir, time_provider, command, checkpoint):
+        """Take over a running process from the checkpoint of the pcron
+           process that we replaced with exec(). The process must still be
+           our child, otherwise we are unable to collect its exit status.
+        """
+        pid = checkpoint["pid"]
+        try:
+            ppid, proc_start = get_process_stat(pid)
+        except OSError:
+            raise RunnerError("process %d is gone" % pid)
+        if ppid != os.getpid() or proc_start != checkpoint["proc_start"]:
+            raise RunnerError("process %d is gone" % pid)
+
+        runner = cls.__new__(cls)
+        runner.working_dir = working_dir
+        runner.time_provider = time_provider
+        runner.command = command
+        runner.output_path = os.path.join(working_dir, "output.txt")
+        runner.script_path = os.path.join(working_dir, "command.sh")
+        runner.start_time = checkpoint["start_time"]
+        runner.stop_time = None
+        runner.usage = None
+
+        try:
+            runner.output = open(runner.output_path, "r+b")
+        except OSError as exc:
+            raise RunnerError("unable to open output of process %d: %s" % (pid, exc))
+        runner.output.seek(0, os.SEEK_END)
+        runner.process = AdoptedProcess(pid)
+        return runner
 
     def has_finished(self):
-        return self.process.poll() is not None
+        if self.process.returncode is None:
+            self.reap(os.WNOHANG)
+        return self.process.returncode is not None
 
     def wait(self):
-        return self.process.wait()
+        while self.process.returncode is None:
+            self.reap(0)
+        return self.process.returncode
+
+    def reap(self, options):
+        """Collect the exit status of the process using os.wait4(), so that we
+           get hold of its resource usage as well.
+        """
+        try:
+            pid, status, usage = os.wait4(self.process.pid, options)
+        except ChildProcessError:
+            # The process has already been reaped elsewhere, let subprocess
+            # deal with it.
+            self.process.poll()
+            return
+
+        if pid != 0:
+            self.process.returncode = os.waitstatus_to_exitcode(status)
+            self.usage = usage
 
     def terminate(self):
         for t in range(3):
@@ -107,7 +312,7 @@ class Runner:
 
     def finalize(self):
         # Save the time when the process ended.
-        self.stop_time = self.time_provider.now()
+        self.stop_time = self.time_provider.time()
 
         self.output.flush()
         self.output.seek(0)
@@ -116,7 +321,7 @@ class Runner:
         if self.has_finished():
             return self.stop_time - self.start_time
         else:
-            return self.time_provider.now() - self.start_time
+            return self.time_provider.time() - self.start_time
 
     def get_pid(self):
         if self.has_finished():
@@ -20,30 +20,48 @@
 # -----------------------------------------------------------------------
 
 import os
+import json
 import signal
 import logging
-import pickle
 import itertools
 import collections
 
-from . import ENVIRONMENT_NAME, CRONTAB_NAME
-from .shared import AtomicFile, Logger, SIGNALS
-from .time import format_time
-from .parser import CrontabParser, CrontabError, extract_loglevel_from_crontab
-from .job import Job
+from . import ENVIRONMENT_NAME, CRONTAB_NAME, CALENDARS_NAME
+from .shared import AtomicFile, Logger, Credentials, SIGNALS, create_environ
+from .time import format_time, to_datetime
+from .state import read_state, write_state, StateError
+from .run import RunnerError, snapshot_environ, format_usage
+from .parser import CrontabParser, CalendarParser, CrontabError, get_default_settings
+from .job import Job, JobQueue
 from .mail import Mailer
+from .limit import NullLimiter, SlotLimiter, LoadMonitor
+from .linux import Inotify, IN_CLOSE_WRITE, IN_MOVED_TO, IN_MOVED_FROM, IN_DELETE, IN_ONLYDIR
 
 
 class Scheduler:
 
     Job = Job
     Mailer = Mailer
+    LoadMonitor = LoadMonitor
 
-    STATE_TAG = 1
+    # The number of seconds after which we check again for jobs that could
+    # not be started for reasons outside of our control.
+    RECHECK_INTERVAL = 10
 
-    def __init__(self, time_provider, directory, logfile=None, persistent_state=True):
+    # Changes to these files in the pcron directory cause a reload, after no
+    # further change has happened for RELOAD_DELAY seconds.
+    WATCH_NAMES = {CRONTAB_NAME, ENVIRONMENT_NAME, CALENDARS_NAME}
+    RELOAD_DELAY = 2
+
+    def __init__(self, time_provider, directory, logfile=None, persistent_state=True,
+                 slot_directory=None, user=None, adopt=False):
         assert os.path.isabs(directory)
 
+        if user is not None:
+            # Run the jobs on behalf of another user.
+            self.Job = type(self.Job.__name__, (self.Job,), {"user": user})
+        self.user = self.Job.user
+
         self.time_provider = time_provider
         self.directory = directory
         self.logfile = logfile
@@ -52,35 +70,48 @@ class Scheduler:
         self.crontab_path = os.path.join(self.directory, CRONTAB_NAME)
         self.environ_path = os.path.join(self.directory, ENVIRONMENT_NAME)
         self.state_path = os.path.join(self.directory, "state.db")
+        self.checkpoint_path = os.path.join(self.directory, "checkpoint.json")
 
         if self.logfile is None:
             self.logfile = open(os.path.join(self.directory, "logfile.txt"), "a")
 
-        try:
-            loglevel = extract_loglevel_from_crontab(self.crontab_path)
-        except CrontabError as exc:
-            log_exc = exc
-            loglevel = None
-
-        self.logger = Logger(self.time_provider, self.logfile, loglevel if loglevel else Logger.INFO)
+        # The loglevel is set from the crontab in load().
+        self.logger = Logger(self.time_provider, self.logfile, Logger.INFO)
 
         self.mailer = self.Mailer(self.logger)
 
         self.log = self.logger.new("main")
         self.log.info("started with pid %d", os.getpid())
 
-        if loglevel is None:
-            self.log.error(str(log_exc))
+        if slot_directory is not None:
+            self.limiter = SlotLimiter(slot_directory, str(self.user.pw_uid), self.logger.new("limit"))
+        else:
+            self.limiter = NullLimiter()
+
+        self.load_monitor = self.LoadMonitor()
 
+        # The running jobs by job id and the waiting jobs by queue name.
         self.running = {}
         self.queues = {}
+        self.queue_widths = {}
         self.serial = collections.Counter()
+        self.recheck = False
+        self.reload_time = None
+        self.config_stat = {}
+        self.restart = False
+        # A process that replaces its predecessor on a hot restart must not
+        # run the @reboot jobs again.
+        self.adopted = adopt
 
         self.init_signal_handling()
+        self.init_watch()
 
         self.load()
         self.load_state()
 
+        if adopt:
+            self.adopt()
+
     def __enter__(self):
         return self
 
@@ -93,11 +124,122 @@ class Scheduler:
     # === Crontab
     #
     def load(self):
+        self.config_stat[CRONTAB_NAME] = self.get_config_stat(CRONTAB_NAME)
+        self.config_stat[CALENDARS_NAME] = self.get_config_stat(CALENDARS_NAME)
+        self.startup, self.crontab, self.settings = self.load_crontab()
+        self.logger.level = Logger.levels[self.settings["loglevel"]]
+        self.load_environment()
+
+        for job in itertools.chain(self.startup.values(), self.crontab.values()):
+            job.init(self.time_provider, self.logger, self.directory, self.init_code, self.environ)
+
+        # A queue runs as many jobs at once as the widest of its jobs allows.
+        self.queue_widths = {}
+        for job in itertools.chain(self.startup.values(), self.crontab.values()):
+            self.queue_widths[job.queue] = max(self.queue_widths.get(job.queue, 1), job.queue_width)
+
+    def load_environment(self):
+        self.config_stat[ENVIRONMENT_NAME] = self.get_config_stat(ENVIRONMENT_NAME)
         self.init_code = self.load_init_code()
-        self.startup, self.crontab = self.load_crontab()
+        self.environ_mtime = self.get_environ_mtime()
+
+        try:
+            # Prepare a basic environment for the jobs.
+            self.environ = create_environ(self.user, PCRONDIR=self.directory)
+        except CrontabError as exc:
+            self.log.error("%s: %s", self.directory, exc)
+            self.log.error("%s: cannot use crontab because the environment is unusable", self.directory)
+            self.startup, self.crontab = {}, {}
+            return
+
+        if self.settings["environment"] == "snapshot":
+            self.log.debug("take a snapshot of %s/%s", self.directory, ENVIRONMENT_NAME)
+            try:
+                self.environ = snapshot_environ(self.directory, self.environ, self.init_code, self.user)
+            except (OSError, RunnerError) as exc:
+                self.log.error("%s: unable to take a snapshot of the environment: %s", self.directory, exc)
+                self.log.error("%s: fall back to sourcing %s for each job", self.directory, ENVIRONMENT_NAME)
+            else:
+                self.init_code = ""
+
+    def get_environ_mtime(self):
+        try:
+            return os.stat(self.environ_path).st_mtime
+        except OSError:
+            return None
+
+    def check_environment(self):
+        """Take a new snapshot of the environment file if it has been changed
+           since the last one.
+        """
+        if self.settings["environment"] != "snapshot" or self.get_environ_mtime() == self.environ_mtime:
+            return
+
+        self.log.info("%s/%s has changed", self.directory, ENVIRONMENT_NAME)
+        self.load_environment()
 
         for job in itertools.chain(self.startup.values(), self.crontab.values()):
-            job.init(self.time_provider, self.logger, self.directory, self.init_code)
+            job.set_environment(self.init_code, self.environ)
+
+    #
+    # === Watching for changes
+    #
+    def init_watch(self):
+        """Watch the pcron directory, so that we notice when the crontab or
+           environment file is replaced.
+        """
+        self.watcher = None
+        try:
+            watcher = Inotify()
+        except OSError as exc:
+            self.log.warn("unable to watch %s for changes: %s", self.directory, exc)
+            return
+
+        try:
+            watcher.add_watch(self.directory,
+                              IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE | IN_ONLYDIR)
+        except OSError as exc:
+            self.log.warn("unable to watch %s for changes: %s", self.directory, exc)
+            watcher.close()
+        else:
+            self.watcher = watcher
+
+    def get_watch_fds(self):
+        return [self.watcher.fileno()] if self.watcher is not None else []
+
+    def get_config_stat(self, name):
+        try:
+            st = os.stat(os.path.join(self.directory, name))
+        except OSError:
+            return None
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    def process_watch_events(self):
+        """Read the pending inotify events. Files that we write ourselves,
+           like the state, the logfile and the job files, are ignored.
+        """
+        if self.watcher is None:
+            return
+
+        names = set(name for _, _, _, name in self.watcher.read() if name in self.WATCH_NAMES)
+        if names:
+            self.log.debug("%s changed", ", ".join(sorted(names)))
+            self.reload_time = self.time_provider.time() + self.RELOAD_DELAY
+
+    def check_reload(self):
+        """Reload the crontab if it has changed and things have calmed down.
+        """
+        if self.reload_time is None or self.time_provider.time() < self.reload_time:
+            return
+
+        self.reload_time = None
+
+        # There is nothing to do if we were sent a SIGHUP in the meantime.
+        if all(self.get_config_stat(name) == stat for name, stat in self.config_stat.items()):
+            return
+
+        self.log.info("configuration has changed, reloading")
+        self.load()
 
     def _load_init_code(self):
         with open(os.path.join(self.directory, ENVIRONMENT_NAME)) as fileobj:
@@ -114,9 +256,16 @@ class Scheduler:
             self.log.error("%s: unable to decode environment file", self.directory)
         return ""
 
+    def load_calendars(self):
+        try:
+            return CalendarParser(os.path.join(self.directory, CALENDARS_NAME)).parse()
+        except FileNotFoundError:
+            return {}
+
     def _load_crontab(self):
-        parser = CrontabParser(self.crontab_path, self.Job)
-        return parser.parse()
+        parser = CrontabParser(self.crontab_path, self.Job, self.load_calendars())
+        startup, crontab = parser.parse()
+        return startup, crontab, parser.settings
 
     def load_crontab(self):
         try:
@@ -128,7 +277,7 @@ class Scheduler:
         except CrontabError as exc:
             self.log.error("%s: %s", self.directory, exc)
             self.log.error("%s: cannot use crontab because it contains errors", self.directory)
-        return {}, {}
+        return {}, {}, get_default_settings(self.Job)
 
     #
     # === State
@@ -138,34 +287,117 @@ class Scheduler:
             self.log.debug("load state from %r", self.state_path)
             try:
                 with open(self.state_path, "rb") as fileobj:
-                    state = pickle.load(fileobj)
-
-                    if state.get("tag") == self.STATE_TAG:
-                        for name, next_run in state["jobs"].items():
-                            try:
-                                self.log.debug("restore %s %s", name, format_time(next_run))
-                                self.crontab[name].next_run = next_run
-                            except KeyError:
-                                continue
-                    else:
-                        self.log.warn("ignore obsolete state")
-
+                    state, legacy = read_state(fileobj)
             except OSError as exc:
                 self.log.warn(str(exc))
+                return
+            except StateError as exc:
+                self.log.warn("ignore state: %s", exc)
+                return
+
+            debug = self.logger.level >= Logger.DEBUG
+            for name, job in self.crontab.items():
+                next_run = state.get(name)
+                if next_run is not None:
+                    if debug:
+                        self.log.debug("restore %s %s", name, format_time(next_run))
+                    job.next_run = next_run
+
+            if legacy:
+                self.log.info("convert state to the new format")
+                self.save_state()
 
     def save_state(self):
         if self.persistent_state:
-            state = {"tag": self.STATE_TAG, "jobs": {}}
-            for job in self.crontab.values():
-                state["jobs"][job.name] = job.next_run
+            state = dict((job.name, job.next_run) for job in self.crontab.values())
 
             self.log.debug("save state to %r", self.state_path)
             try:
                 with AtomicFile(self.state_path) as fileobj:
-                    pickle.dump(state, fileobj)
+                    write_state(fileobj, state)
             except OSError as exc:
                 self.log.warn(str(exc))
 
+    #
+    # === Hot restart
+    #
+    def write_checkpoint(self):
+        """Save the running and waiting jobs, so that the pcron process that
+           replaces us with exec() is able to take them over.
+        """
+        checkpoint = {
+            "pid":      os.getpid(),
+            "serial":   dict(self.Job._serial),
+            "running":  [job.get_checkpoint() for job in self.running.values()],
+            "queues":   dict((name, [job.get_checkpoint() for job in queue])
+                             for name, queue in self.queues.items() if queue)
+        }
+
+        with AtomicFile(self.checkpoint_path) as fileobj:
+            fileobj.write(json.dumps(checkpoint).encode("utf-8"))
+
+    def handover(self):
+        """Prepare for being replaced by a new pcron process with the same pid.
+           Running jobs are left alone, the new process takes them over.
+        """
+        self.log.info("handing over %d running and %d waiting jobs", len(self.running),
+                      sum(len(queue) for queue in self.queues.values()))
+        try:
+            self.write_checkpoint()
+        except (OSError, RunnerError) as exc:
+            self.log.error("unable to write checkpoint: %s", exc)
+            self.shutdown()
+            return
+
+        self.save_state()
+        if self.watcher is not None:
+            self.watcher.close()
+        self.log.debug("handover done")
+
+    def adopt(self):
+        """Take over the running and waiting jobs from the checkpoint that
+           the pcron process we replaced has left.
+        """
+        try:
+            with open(self.checkpoint_path, "rb") as fileobj:
+                checkpoint = json.loads(fileobj.read().decode("utf-8"))
+            os.remove(self.checkpoint_path)
+        except (OSError, ValueError) as exc:
+            self.log.warn("unable to read checkpoint: %s", exc)
+            return
+
+        if checkpoint["pid"] != os.getpid():
+            self.log.warn("checkpoint belongs to another process")
+            return
+
+        for name, serial in checkpoint["serial"].items():
+            self.Job._serial[name] = max(self.Job._serial[name], serial)
+
+        for info in checkpoint["running"]:
+            job = self.restore_job(info)
+            if job is not None:
+                job.log.info("adopted running process %s", job.runner.get_pid())
+                self.limiter.acquire(job.id)
+                self.running[job.id] = job
+
+        for name, infos in checkpoint["queues"].items():
+            for info in infos:
+                job = self.restore_job(info)
+                if job is not None:
+                    job.enqueue(self.queues.setdefault(job.queue, JobQueue()))
+
+    def restore_job(self, info):
+        definition = self.crontab.get(info["name"], self.startup.get(info["name"]))
+        if definition is None:
+            self.log.warn("job %s is no longer in the crontab", info["id"])
+            return None
+
+        try:
+            return definition.restore(info)
+        except RunnerError as exc:
+            self.log.warn("unable to adopt job %s: %s", info["id"], exc)
+            return None
+
     #
     # === Signals
     #
@@ -184,19 +416,36 @@ class Scheduler:
     def dump(self):
         jobs = set()
 
+        self.log.info("[slots]     %d/%s running", len(self.running),
+                      self.settings["max_running"] or "unlimited")
+
+        usage = self.limiter.get_usage()
+        if usage is not None:
+            self.log.info("[host]      %d/%d slots taken by this instance", *usage)
+
         for job in sorted(self.running.values(), key=lambda j: j.this_run):
             self.log.info("[running]   %s  %s", format_time(job.this_run), job.name)
             jobs.add(job.name)
 
-        for queue in sorted((q for q in self.queues.values() if q), key=lambda q: q[0].this_run):
-            job = queue[0]
-            self.log.info("[waiting]   %s  %s", format_time(job.this), job.name)
-            jobs.add(job.name)
+        for queue in sorted((q for q in self.queues.values() if q), key=JobQueue.get_key):
+            for job in queue:
+                self.log.info("[waiting]   %s  %s%s", format_time(job.this_run), job.name,
+                              "  (priority %d)" % job.priority if job.priority else "")
+                jobs.add(job.name)
 
         for job in sorted(self.crontab.values(), key=lambda j: j.next_run):
             if not job.active or job.name in jobs:
                 continue
-            self.log.info("[sleeping]  %s  %s", format_time(job.next_run), job.name)
+            info = []
+            if job.splay is not None:
+                info.append("splay +%s" % format_time(self.time_provider.timedelta(
+                    seconds=job.splay_offset)))
+            if job.days_off is not None:
+                info.append("calendar %s" % job.days_off.name)
+            if job.last_usage is not None:
+                info.append("last run: %s" % format_usage(job.last_usage))
+            self.log.info("[sleeping]  %s  %s%s", format_time(job.next_run), job.name,
+                          "  (%s)" % ", ".join(info) if info else "")
 
         for job in self.crontab.values():
             if job.active or job.name in jobs:
@@ -207,23 +456,66 @@ class Scheduler:
     # === Scheduling
     #
     def mainloop(self):
-        for job in self.startup.values():
-            if job.active:
-                self.enqueue_job(job("reboot"))
-
-        self.log.debug("loop enter")
+        self.start()
 
         signum = None
         while not self.process_signal(signum):
-            self.log.debug("loop iterate")
-            self.process_pending_jobs()
-            self.process_finished_jobs()
-            self.process_waiting_jobs()
+            self.step()
             signum = self.wait()
 
         self.log.debug("loop exit")
 
-        self.shutdown()
+        if self.restart:
+            self.handover()
+        else:
+            self.shutdown()
+
+    def start(self):
+        if not self.adopted:
+            for job in self.startup.values():
+                if job.active:
+                    self.enqueue_job(job("reboot"))
+
+        self.catch_up()
+
+        self.log.debug("loop enter")
+
+    def catch_up(self):
+        """Make up for the runs that were missed while pcron was not running,
+           as far as the catchup policy of each job allows it.
+        """
+        now = self.time_provider.time()
+        for job in self.crontab.values():
+            if not job.active or job.next_run >= now:
+                continue
+
+            missed = max(1, job.count_runs(job.next_run, now + 1))
+            runs = missed if job.catchup is None else min(missed, job.catchup)
+            self.logger.new(job.name).info("missed %d run(s) since %s: catch up %d, skip %d",
+                                           missed, format_time(job.next_run), runs, missed - runs)
+
+            queue = self.queues.get(job.queue, JobQueue())
+            for _ in range(runs):
+                job("catchup").enqueue(queue)
+            self.queues[job.queue] = queue
+
+            # Continue with the first regular run after now. The interval
+            # starts over with the catch-up runs that are made now.
+            resolution = job.get_resolution()
+            interval_start = None
+            if job.interval is not None:
+                interval_start = now // resolution * resolution + job.interval.seconds
+            job.reschedule(self.time_provider.next_tick(resolution), interval_start)
+
+    def step(self):
+        self.log.debug("loop iterate")
+        self.process_watch_events()
+        self.check_reload()
+        self.check_environment()
+        self.process_pending_jobs()
+        self.process_overdue_jobs()
+        self.process_finished_jobs()
+        self.process_waiting_jobs()
 
     def process_signal(self, signum):
         """Process the last signal, return True if a termination signal has
@@ -242,6 +534,11 @@ class Scheduler:
             self.log.debug("received SIGUSR1 signal, dumping state")
             self.dump()
 
+        elif signum == signal.SIGUSR2:
+            self.log.warn("received SIGUSR2 signal, restarting")
+            self.restart = True
+            return True
+
         elif signum == signal.SIGHUP:
             self.log.debug("received SIGHUP signal, reloading crontab")
             self.load()
@@ -261,12 +558,23 @@ class Scheduler:
         """Go through the crontab and enqueue jobs that are supposed to be
            scheduled.
         """
-        now = self.time_provider.now()
+        now = self.time_provider.time()
         for job in self.crontab.values():
             if job.active and job.next_run <= now:
                 self.enqueue_job(job(job.next_trigger))
                 job.advance()
 
+    def process_overdue_jobs(self):
+        """Go through the list of running jobs and terminate those that have
+           exceeded their timeout.
+        """
+        now = self.time_provider.time()
+        for job in list(self.running.values()):
+            if job.get_deadline() <= now and not job.has_finished():
+                job.log.warn("timeout: exceeding runtime of %s -> kill", job.timeout)
+                job.timed_out = True
+                job.terminate()
+
     def process_finished_jobs(self):
         """Go through the list of running jobs and look for jobs that have
            finished.
@@ -274,18 +582,21 @@ class Scheduler:
         state_changed = False
         for job in list(self.running.values()):
             if job.has_finished():
-                self.running.pop(job.queue)
+                self.running.pop(job.id)
+                self.limiter.release(job.id)
                 job.finalize()
                 self.mailer.send_job_mail(job)
                 job.close()
 
+                name = job.name
                 for j in self.crontab.values():
-                    if j.active and job.name in j.post:
+                    if j.active and name in j.post:
                         self.enqueue_job(j("post"))
 
                         # Reset the interval timestamp generator.
                         if j.interval is not None:
-                            j.interval.reset_timestamp_generator(j.time_provider.next_minute())
+                            j.interval.reset_timestamp_generator(
+                                j.time_provider.next_tick(j.get_resolution()))
 
                 state_changed = True
 
@@ -293,53 +604,150 @@ class Scheduler:
             self.save_state()
 
     def process_waiting_jobs(self):
-        """Go through the queues and start a waiting job for each queue that
-           has currently no running job.
+        """Go through the queues and start waiting jobs for each queue that
+           has fewer running jobs than its width allows, as long as there are
+           free slots. Jobs with a higher priority and jobs that have been
+           waiting longer are started first.
         """
-        for name, queue in sorted(self.queues.items(), reverse=False):
-            if not queue:
-                continue
-            while queue and queue[0].queue not in self.running:
-                job = queue.pop(0)
+        self.recheck = False
+        self.load_monitor.reset()
+
+        exhausted = False
+        queues = [queue for queue in self.queues.values() if queue]
+        for queue in sorted(queues, key=JobQueue.get_key):
+            while queue and self.has_free_slot():
+                job = self.get_next_waiting_job(queue)
+                if job is None:
+                    break
+
+                if self.is_deferred(job):
+                    # The system is too busy, check again later.
+                    self.recheck = True
+                    break
+
+                if not self.limiter.acquire(job.id):
+                    # All host-wide slots are taken, check again later.
+                    self.recheck = exhausted = True
+                    break
+
+                queue.remove(job)
                 self.start_job(job)
 
-    def wait(self):
+            if exhausted:
+                break
+
+        self.limiter.set_active(bool(self.running) or any(self.queues.values()))
+
+    def get_running_jobs(self, name):
+        """Return the running jobs of a queue.
+        """
+        return [job for job in self.running.values() if job.queue == name]
+
+    def get_next_waiting_job(self, queue):
+        """Return the first job from a queue that may start now, or None if
+           the queue is full. A job never runs twice at the same time, so jobs
+           whose previous run is still going are passed over.
+        """
+        name = queue.peek().queue
+        running = self.get_running_jobs(name)
+        if len(running) >= self.queue_widths.get(name, 1):
+            return None
+
+        names = set(job.name for job in running)
+        if queue.peek().name not in names:
+            return queue.peek()
+        for job in queue:
+            if job.name not in names:
+                return job
+        return None
+
+    def is_deferred(self, job):
+        """Return True if the job must be held back because the system load
+           exceeds the job's thresholds and its deadline has not yet been
+           reached.
+        """
+        if job.defer_if_load is None:
+            return False
+
+        exceeded = self.load_monitor.get_exceeded(job.defer_if_load)
+        if not exceeded:
+            return False
+
+        if job.deadline is not None and \
+                self.time_provider.time() >= job.this_run + job.deadline.seconds:
+            job.log.warn("deadline reached, start despite high load: %s", ", ".join(exceeded))
+            return False
+
+        if not job.deferred:
+            job.log.info("defer because of high load: %s", ", ".join(exceeded))
+            job.deferred = True
+        return True
+
+    def has_free_slot(self):
+        max_running = self.settings["max_running"]
+        return not max_running or len(self.running) < max_running
+
+    def get_wakeup(self):
+        """Return the point in time when the next iteration of the loop is
+           due.
+        """
         next_run = self.time_provider.infinity
 
         for job in self.crontab.values():
             if job.active and job.next_run < next_run:
                 next_run = job.next_run
 
-        if next_run is not self.time_provider.infinity:
-            sleep = next_run - self.time_provider.now()
-        else:
-            sleep = self.time_provider.timedelta(minutes=60)
+        for job in self.running.values():
+            deadline = job.get_deadline()
+            if deadline < next_run:
+                next_run = deadline
 
-        seconds = sleep.total_seconds()
+        if self.recheck:
+            recheck = self.time_provider.time() + self.RECHECK_INTERVAL
+            if recheck < next_run:
+                next_run = recheck
 
-        if seconds > 0:
+        if self.reload_time is not None and self.reload_time < next_run:
+            next_run = self.reload_time
+
+        return next_run
+
+    def wait(self):
+        next_run = self.get_wakeup()
+        now = self.time_provider.time()
+
+        if next_run == self.time_provider.infinity:
+            next_run = now + 3600
+
+        if next_run > now:
             # FIXME
-            self.log.debug("sleep until %s", (self.time_provider.now() + sleep).strftime("%H:%M"))
-            return self.time_provider.sleep(seconds)
+            self.log.debug("sleep until %s", to_datetime(next_run).strftime("%H:%M:%S"))
+            return self.time_provider.sleep_until(next_run, self.get_watch_fds())
 
     def shutdown(self):
         self.log.debug("shutting down ...")
         for job in self.running.values():
             job.terminate()
         self.process_finished_jobs()
+        self.limiter.set_active(False)
         self.save_state()
+        if self.watcher is not None:
+            self.watcher.close()
         self.log.debug("shutting down done")
 
     def start_job(self, job):
         if job.start():
-            self.running[job.queue] = job
+            self.running[job.id] = job
+        else:
+            self.limiter.release(job.id)
 
     def enqueue_job(self, job):
-        running_job = self.running.get(job.queue)
-        queue = self.queues.get(job.queue, [])
+        running = self.get_running_jobs(job.queue)
+        running_job = next((j for j in running if j.name == job.name), None)
+        queue = self.queues.get(job.queue, JobQueue())
         names = set(j.name for j in queue)
 
-        if running_job is not None and running_job.name == job.name:
+        if running_job is not None:
             job.log.debug("queue %s blocked by %s", job.queue, running_job)
             running_job.log.warn("scheduling conflict: exceeding runtime -> %s" % job.conflict)
 
@@ -360,10 +768,122 @@ class Scheduler:
                 job.enqueue(queue)
 
             elif job.warn:
-                self.mailer.send_conflict_mail(job, running_job, False)
+                self.mailer.send_conflict_mail(job, running[0] if running else None, False)
 
         else:
             job.enqueue(queue)
 
         self.queues[job.queue]= queue
 
+
+
+class MultiScheduler:
+    """Run the schedulers of several users in a single process and a single
+       loop. Each scheduler does its work with the effective user and group
+       ids of its user, and the job processes are started with the user's
+       ids.
+    """
+
+    Scheduler = Scheduler
+
+    def __init__(self, time_provider, log):
+        self.time_provider = time_provider
+        self.log = log
+        self.schedulers = collections.OrderedDict()
+        # The users whose schedulers have been dropped after an error.
+        self.failed = []
+
+        self.init_signal_handling()
+
+    def init_signal_handling(self):
+        # See Scheduler.init_signal_handling().
+        signal.pthread_sigmask(signal.SIG_BLOCK, SIGNALS)
+
+    def add(self, record, directory, **kwargs):
+        credentials = Credentials(record)
+        with credentials:
+            scheduler = self.Scheduler(self.time_provider, directory, user=record, **kwargs)
+            scheduler.start()
+        self.schedulers[record.pw_name] = (credentials, scheduler)
+
+    def call(self, name, method, *args):
+        """Call a method of a user's scheduler. An internal error only stops
+           the scheduler concerned.
+        """
+        credentials, scheduler = self.schedulers[name]
+        try:
+            with credentials:
+                return getattr(scheduler, method)(*args)
+        except Exception:
+            self.log.exception("scheduler for user %s failed:", name)
+            try:
+                with credentials:
+                    scheduler.log.exception("a fatal internal error occurred:")
+                    if scheduler.watcher is not None:
+                        scheduler.watcher.close()
+            except Exception:
+                pass
+            del self.schedulers[name]
+            self.failed.append(name)
+
+    def pop_failed(self):
+        """Return the users whose schedulers have failed since the last call.
+        """
+        failed, self.failed = self.failed, []
+        return failed
+
+    def mainloop(self):
+        signum = None
+        while not self.process_signal(signum):
+            self.step(signum)
+            signum = self.wait()
+
+        self.shutdown()
+
+    def process_signal(self, signum):
+        """Pass the last signal on to all schedulers, return True if a
+           termination signal has been received.
+        """
+        terminate = signum in (signal.SIGINT, signal.SIGTERM)
+        if signum == signal.SIGUSR2:
+            self.log.warn("hot restart is not supported in single-process mode")
+        elif signum is not None:
+            for name in list(self.schedulers):
+                self.call(name, "process_signal", signum)
+        return terminate
+
+    def step(self, signum=None):
+        """Let each scheduler do its work. Unless a signal has been received,
+           schedulers that have nothing to do are skipped. Jobs that are
+           running or waiting in a queue always need attention.
+        """
+        now = self.time_provider.time()
+        for name, (_, scheduler) in list(self.schedulers.items()):
+            scheduler.process_watch_events()
+            if signum is None and not scheduler.running and \
+                    not any(scheduler.queues.values()) and scheduler.get_wakeup() > now:
+                continue
+            self.call(name, "step")
+
+    def wait(self, timeout=None, fds=()):
+        """Sleep until the next scheduler is due or for at most timeout
+           seconds. Wake up early if one of fds becomes readable.
+        """
+        now = self.time_provider.time()
+
+        if timeout is not None:
+            next_run = now + timeout
+        else:
+            next_run = now + 3600
+
+        fds = list(fds)
+        for _, scheduler in self.schedulers.values():
+            next_run = min(next_run, scheduler.get_wakeup())
+            fds += scheduler.get_watch_fds()
+
+        if next_run > now:
+            return self.time_provider.sleep_until(next_run, fds)
+
+    def shutdown(self):
+        for name in list(self.schedulers):
+            self.call(name, "shutdown")
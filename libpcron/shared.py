@@ -26,7 +26,7 @@ import traceback
 import signal
 
 
-SIGNALS = {signal.SIGINT, signal.SIGTERM, signal.SIGHUP, signal.SIGUSR1, signal.SIGCHLD}
+SIGNALS = {signal.SIGINT, signal.SIGTERM, signal.SIGHUP, signal.SIGUSR1, signal.SIGUSR2, signal.SIGCHLD}
 
 EXC_PREFIX = ">>> "
 
@@ -35,7 +35,11 @@ class ParserError(Exception):
     pass
 
 class CrontabError(ParserError):
-    pass
+
+    def __init__(self, message, option=None):
+        super().__init__(message)
+        # The name of the variable the error refers to, if any.
+        self.option = option
 
 class CrontabEmptyError(CrontabError):
     pass
@@ -197,6 +201,37 @@ class Logger(NullLogger):
             print("%s  %-7s  %-12s  %s" % record, file=self.file, flush=True)
 
 
+class Credentials:
+    """Act on behalf of another user for the duration of a with block by
+       switching the effective user and group ids of the process. The real
+       ids remain those of the superuser, so that we are able to switch back
+       afterwards. Processes that are started inside the block must therefore
+       set their real ids themselves, see run.get_popen_options(). If the
+       process already runs as the user, nothing is changed.
+    """
+
+    def __init__(self, record):
+        self.record = record
+        self.groups = os.getgrouplist(record.pw_name, record.pw_gid)
+        self.saved = None
+
+    def __enter__(self):
+        if os.geteuid() != self.record.pw_uid:
+            self.saved = os.geteuid(), os.getegid(), os.getgroups()
+            os.setgroups(self.groups)
+            os.setegid(self.record.pw_gid)
+            os.seteuid(self.record.pw_uid)
+        return self
+
+    def __exit__(self, *exc):
+        if self.saved is not None:
+            uid, gid, groups = self.saved
+            os.seteuid(uid)
+            os.setegid(gid)
+            os.setgroups(groups)
+            self.saved = None
+
+
 def create_environ(record, **kwargs):
     if not os.access(record.pw_shell, os.X_OK):
         raise CrontabError("shell %s is inaccessible" % record.pw_shell)
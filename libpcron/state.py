@@ -0,0 +1,208 @@
+# -----------------------------------------------------------------------
+#
+# pcron - a periodic cron-like job scheduler.
+# Copyright (C) 2009-2016 Lars Gustäbel <lars@gustaebel.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+# -----------------------------------------------------------------------
+
+# The state file stores the next run time of every job. Its layout is:
+#
+#   header      magic, version and number of jobs
+#   values      one little-endian int64 per job (local epoch seconds)
+#   offsets     number of jobs + 1 little-endian uint32 offsets into names
+#   names       the NUL-terminated UTF-8 job names in sorted order
+#
+# Because the names are sorted, a single job can be looked up in the
+# memory-mapped file with a binary search without reading the whole file.
+
+import sys
+import mmap
+import array
+import struct
+import pickle
+import bisect
+import datetime
+import itertools
+
+from .time import to_seconds
+
+MAGIC = b"PCRONST\0"
+VERSION = 2
+
+# The tag of the pickle format that was used before.
+LEGACY_TAG = 1
+
+header = struct.Struct("<8sII")
+
+
+class StateError(Exception):
+    pass
+
+
+def _native(values):
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+def write_state(fileobj, jobs):
+    """Write a dictionary of job names and next run times to fileobj.
+    """
+    names = sorted(jobs)
+    encoded = [name.encode("utf-8") + b"\0" for name in names]
+
+    values = _native(array.array("q", [jobs[name] for name in names]))
+    offsets = _native(array.array("I", itertools.accumulate((len(name) for name in encoded),
+                                                            initial=0)))
+
+    fileobj.write(header.pack(MAGIC, VERSION, len(names)))
+    fileobj.write(values.tobytes())
+    fileobj.write(offsets.tobytes())
+    fileobj.write(b"".join(encoded))
+
+
+class _Names:
+    """A sequence view of the sorted names in the state file for bisect.
+    """
+
+    def __init__(self, state):
+        self.state = state
+
+    def __len__(self):
+        return len(self.state)
+
+    def __getitem__(self, index):
+        return self.state.get_name(index)
+
+
+class StateFile:
+    """Read-only access to a memory-mapped state file.
+    """
+
+    def __init__(self, fileobj):
+        self.map = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.parse()
+        except StateError:
+            self.map.close()
+            raise
+
+    def parse(self):
+        if len(self.map) < header.size:
+            raise StateError("state file is truncated")
+
+        magic, version, self.count = header.unpack_from(self.map)
+        if magic != MAGIC:
+            raise StateError("state file has an unknown format")
+        if version != VERSION:
+            raise StateError("state file has unsupported version %d" % version)
+
+        self.values_start = header.size
+        self.offsets_start = self.values_start + self.count * 8
+        self.names_start = self.offsets_start + (self.count + 1) * 4
+
+        if len(self.map) < self.names_start or \
+                len(self.map) != self.names_start + self.get_offset(self.count):
+            raise StateError("state file is truncated")
+
+    def __len__(self):
+        return self.count
+
+    def get_offset(self, index):
+        return struct.unpack_from("<I", self.map, self.offsets_start + index * 4)[0]
+
+    def get_name(self, index):
+        start = self.names_start + self.get_offset(index)
+        stop = self.names_start + self.get_offset(index + 1) - 1
+        if not self.names_start <= start <= stop < len(self.map) or self.map[stop] != 0:
+            raise StateError("state file is corrupt")
+        try:
+            return self.map[start:stop].decode("utf-8")
+        except UnicodeDecodeError:
+            raise StateError("state file is corrupt")
+
+    def get_value(self, index):
+        return struct.unpack_from("<q", self.map, self.values_start + index * 8)[0]
+
+    def get(self, name, default=None):
+        """Look up the next run time of a single job.
+        """
+        index = bisect.bisect_left(_Names(self), name)
+        if index < self.count and self.get_name(index) == name:
+            return self.get_value(index)
+        return default
+
+    def items(self):
+        """Return a list of all (name, next run time) pairs.
+        """
+        try:
+            names = self.map[self.names_start:].decode("utf-8").split("\0")[:-1]
+        except UnicodeDecodeError:
+            raise StateError("state file is corrupt")
+        if len(names) != self.count:
+            raise StateError("state file is corrupt")
+
+        values = array.array("q")
+        values.frombytes(self.map[self.values_start:self.offsets_start])
+        return list(zip(names, _native(values)))
+
+    def close(self):
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _LegacyUnpickler(pickle.Unpickler):
+    """Unpickle the old state format, which consists of builtin types and
+       datetime objects only, without giving access to anything else.
+    """
+
+    def find_class(self, module, name):
+        if (module, name) == ("datetime", "datetime"):
+            return datetime.datetime
+        raise pickle.UnpicklingError("forbidden global %s.%s" % (module, name))
+
+
+def read_legacy_state(fileobj):
+    """Return a dictionary of job names and next run times from a state file
+       in the old pickle format.
+    """
+    try:
+        state = _LegacyUnpickler(fileobj).load()
+        if state.get("tag") != LEGACY_TAG:
+            raise StateError("obsolete state")
+        return dict((name, to_seconds(next_run)) for name, next_run in state["jobs"].items())
+    except (pickle.UnpicklingError, EOFError, AttributeError, KeyError, TypeError,
+            ValueError) as exc:
+        raise StateError("unable to read old state: %s" % exc)
+
+
+def read_state(fileobj):
+    """Return a dictionary of job names and next run times from a state file
+       in either format. The second value tells whether the old format was
+       found.
+    """
+    if fileobj.read(len(MAGIC)) != MAGIC:
+        fileobj.seek(0)
+        return read_legacy_state(fileobj), True
+
+    with StateFile(fileobj) as state:
+        return dict(state.items()), False
@@ -22,11 +22,41 @@
 import re
 import time
 import signal
+import select
 import datetime
 
 from queue import Empty
 
 from .shared import ParserError, SIGNALS
+from .linux import SignalFD, TimerFD
+
+
+# Points in time are integer seconds since the epoch in local time, i.e. the
+# wall-clock time that the crontab refers to. They are converted to datetime
+# objects only for display.
+EPOCH = datetime.datetime(1970, 1, 1)
+EPOCH_ORDINAL = EPOCH.toordinal()
+
+
+def to_seconds(dt):
+    """Convert a naive datetime object to local epoch seconds.
+    """
+    return (dt.toordinal() - EPOCH_ORDINAL) * 86400 + dt.hour * 3600 + dt.minute * 60 + dt.second
+
+
+def to_datetime(seconds):
+    """Convert local epoch seconds to a naive datetime object.
+    """
+    return EPOCH + datetime.timedelta(seconds=seconds)
+
+
+def to_posix(seconds):
+    """Convert local epoch seconds to seconds since the epoch in UTC.
+    """
+    return time.mktime(time.gmtime(seconds)[:8] + (-1,))
+
+
+INFINITY = to_seconds(datetime.datetime.max)
 
 
 class TimeSpecError(ParserError):
@@ -59,11 +89,19 @@ class TimeSpec:
         elif self.value == "@hourly":
             self.value = "0 * * * *"
 
+        # An optional sixth field in front of the others holds the seconds.
+        fields = self.value.split()
+        if len(fields) == 6:
+            second = fields.pop(0)
+        else:
+            second = "0"
+
         try:
-            minute, hour, days_of_month, month, days_of_week = self.value.split()
+            minute, hour, days_of_month, month, days_of_week = fields
         except ValueError:
             raise TimeSpecError("malformed timestamp:%r" % self.value)
 
+        self.seconds = self.parse_second(second)
         self.minutes = self.parse_minute(minute)
         self.hours = self.parse_hour(hour)
         self.days_of_month = self.parse_day_of_month(days_of_month)
@@ -73,6 +111,9 @@ class TimeSpec:
         self.days_of_month_set = days_of_month != "*"
         self.days_of_week_set = days_of_week != "*"
 
+        # The granularity of the time stamps in seconds.
+        self.resolution = 60 if self.seconds == [0] else 1
+
     @classmethod
     def _parse_spec(cls, name, minimum, maximum, value, names=None):
         result = set()
@@ -145,6 +186,10 @@ class TimeSpec:
 
         return list(sorted(result))
 
+    @classmethod
+    def parse_second(cls, value):
+        return cls._parse_spec("second", 0, 60, value)
+
     @classmethod
     def parse_minute(cls, value):
         return cls._parse_spec("minute", 0, 60, value)
@@ -171,54 +216,111 @@ class TimeSpec:
             "day of week", 0, 8, value,
             {"sun": 0, "mon": 1, "tue": 2, "wed": 3, "thu": 4, "fri": 5, "sat": 6})
 
-    def match(self, dt):
+    def match(self, seconds):
         # NOTE This is used in the unittests only.
-        return dt == next(self.timestamp_generator(dt))
+        return seconds == next(self.timestamp_generator(seconds))
 
-    def iter_days(self, year, month):
+    def iter_days(self, year, month, days_off=None):
         """Generate a list of the days of a particular month (starting at day).
 
         The days have to be recalculated for every month, because weekdays
         must be taken into account. If both "day of month" and "day of week" are
         not `*` placeholders, they both add up instead of restricting each other.
+        Days that are in the days_off calendar are left out.
         """
+        if days_off is not None:
+            # Shift the bitmap of the year so that bit 0 is the 1st of the month.
+            excluded = days_off.get_bitmap(year) >> \
+                    (datetime.date(year, month, 1).timetuple().tm_yday - 1)
+        else:
+            excluded = 0
+
         for day in range(1, 32):
             try:
                 date = datetime.date(year, month, day)
             except ValueError:
                 break
 
-            if not self.days_of_month_set and not self.days_of_week_set:
+            if excluded >> (day - 1) & 1:
+                continue
+            elif not self.days_of_month_set and not self.days_of_week_set:
                 yield date.day
             elif self.days_of_month_set and date.day in self.days_of_month:
                 yield date.day
             elif self.days_of_week_set and date.isoweekday() % 7 in self.days_of_week:
                 yield date.day
 
-    def timestamp_generator(self, now):
-        """Infinite generator of time stamps.
+    def timestamp_generator(self, now, days_off=None):
+        """Infinite generator of time stamps, optionally leaving out the days
+           of a Calendar.
         """
-        year = now.year
-        months = [m for m in self.months if m >= now.month]
-
-        while True:
+        start = to_datetime(now)
+        year = start.year
+        months = [m for m in self.months if m >= start.month]
+
+        # The calendar repeats itself after 400 years. If nothing matches
+        # within that time, e.g. because the calendar leaves no day, it
+        # never will.
+        last_year = year
+        while year - last_year <= 400:
             for month in months:
-                for day in self.iter_days(year, month):
+                first = (datetime.date(year, month, 1).toordinal() - EPOCH_ORDINAL) * 86400
+                for day in self.iter_days(year, month, days_off):
+                    midnight = first + (day - 1) * 86400
+                    if midnight + 86400 <= now:
+                        continue
                     for hour in self.hours:
+                        hour = midnight + hour * 3600
+                        if hour + 3600 <= now:
+                            continue
                         for minute in self.minutes:
-                            try:
-                                date = datetime.datetime(year=year, month=month,
-                                        day=day, hour=hour, minute=minute)
-                            except ValueError:
+                            minute = hour + minute * 60
+                            if minute + 60 <= now:
                                 continue
-                            else:
-                                if date >= now:
-                                    yield date
+                            for second in self.seconds:
+                                if minute + second >= now:
+                                    last_year = year
+                                    yield minute + second
             months = self.months
             year += 1
 
+    def count(self, start, stop, days_off=None):
+        """Return the number of time stamps t with start <= t < stop. Days
+           that lie completely inside the range are counted as a whole, so
+           that long ranges do not have to be generated minute by minute.
+        """
+        if stop <= start:
+            return 0
+
+        per_day = len(self.hours) * len(self.minutes) * len(self.seconds)
+        first = to_datetime(start)
+        last = to_datetime(stop - 1)
+
+        count = 0
+        for year in range(first.year, last.year + 1):
+            for month in self.months:
+                if (year, month) < (first.year, first.month) or (year, month) > (last.year, last.month):
+                    continue
+
+                offset = (datetime.date(year, month, 1).toordinal() - EPOCH_ORDINAL) * 86400
+                for day in self.iter_days(year, month, days_off):
+                    midnight = offset + (day - 1) * 86400
+                    if midnight + 86400 <= start or midnight >= stop:
+                        continue
+                    if start <= midnight and midnight + 86400 <= stop:
+                        count += per_day
+                        continue
+                    for hour in self.hours:
+                        for minute in self.minutes:
+                            minute = midnight + hour * 3600 + minute * 60
+                            for second in self.seconds:
+                                if start <= minute + second < stop:
+                                    count += 1
+        return count
+
     def as_tuple(self):
-        return (self.minutes, self.hours, self.days_of_month, self.months, self.days_of_week)
+        return (self.seconds, self.minutes, self.hours, self.days_of_month, self.months,
+                self.days_of_week)
 
     def __eq__(self, other):
         if not isinstance(other, self.__class__):
@@ -236,13 +338,16 @@ class IntervalSpec:
 
     # XXX be more permissive?
     r_interval = re.compile(r"(?:(?P<month>\d+)m)?(?:(?P<week>\d+)w)?(?:(?P<day>\d+)d)?"\
-                            r"(?:(?P<hour>\d+)h)?(?:(?P<minute>\d+))?$", re.IGNORECASE)
+                            r"(?:(?P<hour>\d+)h)?(?:(?P<minute>\d+)|(?P<second>\d+)s)?$",
+                            re.IGNORECASE)
 
     def __init__(self, value, allow_zero=False):
         self.value = value
         self.interval = self.parse(value)
         if not allow_zero and not self.interval:
             raise IntervalSpecError("interval must not be zero")
+        self.seconds = int(self.interval.total_seconds())
+        self.resolution = 60 if self.seconds % 60 == 0 else 1
         self.dt = None
 
     def parse(self, value):
@@ -262,24 +367,25 @@ class IntervalSpec:
         td += datetime.timedelta(days=values.get("day", 0))
         td += datetime.timedelta(hours=values.get("hour", 0))
         td += datetime.timedelta(minutes=values.get("minute", 0))
+        td += datetime.timedelta(seconds=values.get("second", 0))
         return td
 
     def get_timedelta(self):
         return self.interval
 
-    def match(self, dt, last):
-        return dt >= last + self.interval
+    def match(self, seconds, last):
+        return seconds >= last + self.seconds
 
-    def timestamp_generator(self, dt):
+    def timestamp_generator(self, seconds):
         """Infinite generator of time stamps.
         """
-        self.dt = dt
+        self.dt = seconds
         while True:
             yield self.dt
-            self.dt += self.get_timedelta()
+            self.dt += self.seconds
 
-    def reset_timestamp_generator(self, dt):
-        self.dt = dt
+    def reset_timestamp_generator(self, seconds):
+        self.dt = seconds
 
     def __eq__(self, other):
         if not isinstance(other, self.__class__):
@@ -298,6 +404,10 @@ def format_time(t):
     # pylint:disable=no-member
     if isinstance(t, float):
         t = datetime.datetime.fromtimestamp(t)
+    elif isinstance(t, int):
+        if t == INFINITY:
+            return "--------/----"
+        t = to_datetime(t)
 
     if isinstance(t, datetime.timedelta):
         seconds = t.total_seconds()
@@ -324,6 +434,8 @@ def format_time(t):
     elif isinstance(t, datetime.datetime):
         if t == datetime.datetime.max:
             return "--------/----"
+        elif t.second:
+            return t.strftime("%Y%m%d/%H%M%S")
         else:
             return t.strftime("%Y%m%d/%H%M")
 
@@ -332,13 +444,14 @@ def format_time(t):
 
 
 class TimeProvider:
-    """The TimeProvider class provides time-related functions that are based on
-       the datetime module that offer real-time operation. The sole purpose of
-       this class is that we can have the TestTimeProvider subclass.
+    """The TimeProvider class provides time-related functions that offer
+       real-time operation. The sole purpose of this class is that we can have
+       the TestTimeProvider subclass. Scheduling is done in integer local epoch
+       seconds, now() is only used for display.
     """
 
     origin = datetime.datetime.min
-    infinity = datetime.datetime.max
+    infinity = INFINITY
 
     timedelta = datetime.timedelta
     datetime = datetime.datetime
@@ -346,13 +459,75 @@ class TimeProvider:
     def now(self):
         return datetime.datetime.now()
 
+    def time(self):
+        """Return the current local time in epoch seconds.
+        """
+        seconds = int(time.time())
+        return seconds + time.localtime(seconds).tm_gmtoff
+
     def next_minute(self):
-        return datetime.datetime.now().replace(second=0, microsecond=0) + self.timedelta(seconds=60)
+        return self.next_tick(60)
+
+    def next_tick(self, resolution):
+        """Return the next point in time that is a multiple of resolution
+           seconds.
+        """
+        return self.time() // resolution * resolution + resolution
 
-    def sleep(self, seconds):
-        """Sleep for a certain amount of seconds.
+    signalfd = None
+    timerfd = None
+
+    def sleep_until(self, deadline, fds=()):
+        """Sleep until the point in time deadline or until one of the file
+           descriptors becomes readable. Unlike sleep(), this wakes up at
+           the right time even if the clock is changed or the system is
+           suspended in the meantime. Return the number of the signal that
+           has been received in the meantime, if any.
+        """
+        if self.get_signalfd() is None or self.get_timerfd() is None:
+            return self.sleep(max(deadline - self.time(), 0), fds)
+
+        # If the clock is set, the timer is cancelled, and we return early so
+        # that the caller computes a new deadline.
+        self.timerfd.set(to_posix(deadline))
+        poll = select.poll()
+        for fd in [self.signalfd, self.timerfd] + list(fds):
+            poll.register(fd, select.POLLIN)
+        poll.poll()
+        self.timerfd.read()
+        return self.signalfd.read()
+
+    def sleep(self, seconds, fds=()):
+        """Sleep for a certain amount of seconds or until one of the file
+           descriptors becomes readable. Return the number of the signal that
+           has been received in the meantime, if any.
         """
+        if fds and self.get_signalfd() is not None:
+            poll = select.poll()
+            for fd in [self.signalfd] + list(fds):
+                poll.register(fd, select.POLLIN)
+            poll.poll(seconds * 1000)
+            return self.signalfd.read()
+
+        # Without a signalfd, the file descriptors are only looked at when
+        # we wake up for other reasons.
         ret = signal.sigtimedwait(SIGNALS, seconds)
         if ret is not None:
             return ret.si_signo
 
+    def get_signalfd(self):
+        if self.signalfd is None:
+            try:
+                self.signalfd = SignalFD(SIGNALS)
+            except OSError:
+                self.signalfd = False
+        return self.signalfd or None
+
+    def get_timerfd(self):
+        if self.timerfd is None:
+            try:
+                self.timerfd = TimerFD()
+            except OSError:
+                self.timerfd = False
+        return self.timerfd or None
+
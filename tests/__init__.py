@@ -32,11 +32,13 @@ import tempfile
 import email
 import signal
 import collections
+import importlib.machinery
+import importlib.util
 
 from libpcron.time import TimeSpec, TimeSpecError, IntervalSpec, \
         IntervalSpecError, format_time
-from libpcron.scheduler import Scheduler
-from libpcron.time import TimeProvider
+from libpcron.scheduler import Scheduler, MultiScheduler
+from libpcron.time import TimeProvider, to_seconds, to_datetime
 from libpcron.parser import CrontabParser, CrontabError
 from libpcron.job import Job
 from libpcron.mail import Mailer
@@ -59,19 +61,19 @@ class TestTimeProvider(TimeProvider):
     def __init__(self, start=None, stop=None):
         # Use the first monday in 1970 by default (but start one second before midnight
         # so that we schedule right on 00:00).
-        self._now = start if start is not None else datetime.datetime(1970, 1, 4, 23, 59, 59)
-        self._stop = stop if stop is not None else datetime.datetime(1970, 1, 5, 23, 59, 59)
+        self._now = to_seconds(start if start is not None else datetime.datetime(1970, 1, 4, 23, 59, 59))
+        self._stop = to_seconds(stop if stop is not None else datetime.datetime(1970, 1, 5, 23, 59, 59))
 
         self.child_signals = []
 
     def now(self):
-        # Produce a somewhat more realistic time by adding 1 microsecond
-        # for each call to now().
-        self._now = self._now.replace(microsecond=self._now.microsecond + 1)
+        return to_datetime(self._now)
+
+    def time(self):
         return self._now
 
     def next_minute(self):
-        return self._now.replace(second=0, microsecond=0) + self.timedelta(seconds=60)
+        return self._now // 60 * 60 + 60
 
     def schedule_child_signal(self, ts):
         # Tell the time provider when a job is about to end, so that
@@ -79,9 +81,12 @@ class TestTimeProvider(TimeProvider):
         self.child_signals.append(ts)
         self.child_signals.sort()
 
-    def sleep(self, seconds):
+    def sleep_until(self, deadline, fds=()):
+        return self.sleep(deadline - self._now, fds)
+
+    def sleep(self, seconds, fds=()):
         # We're asked to wake up at this point in time.
-        wakeup = self.now() + self.timedelta(seconds=seconds)
+        wakeup = self._now + seconds
         raise_child_signal = False
 
         # Check if a running job has told us earlier that it will end before
@@ -91,8 +96,8 @@ class TestTimeProvider(TimeProvider):
             raise_child_signal = True
 
         # Check if the end of time has come, and give the pcron process the
-        # command to shut down.
-        if wakeup > self._stop:
+        # command to shut down. The stop time itself is excluded.
+        if wakeup >= self._stop:
             return signal.SIGTERM
 
         # Advance to the new point in time.
@@ -111,7 +116,8 @@ class TestRunner:
 
     # FIXME Simulate output too?
 
-    def __init__(self, working_dir, time_provider, command, environ, init_code):
+    def __init__(self, working_dir, time_provider, command, environ, init_code, wrapper=(),
+                 user=None):
         # pylint:disable=unused-argument
         self.time_provider = time_provider
         self.environ = environ
@@ -125,14 +131,12 @@ class TestRunner:
 
         # Reduce the duration slightly to prevent the job
         # from ending exactly one the minute-border.
-        interval = IntervalSpec(duration).interval
-        interval -= self.time_provider.timedelta(seconds=1)
-
-        self.duration = interval
+        self.duration = IntervalSpec(duration).seconds - 1
         self.exit_code = int(exit_code)
 
-        self.start_time = self.time_provider.now()
+        self.start_time = self.time_provider.time()
         self.stop_time = self.start_time + self.duration
+        self.usage = None
 
         # Tell the time provider when this process will finish.
         self.time_provider.schedule_child_signal(self.stop_time)
@@ -141,11 +145,28 @@ class TestRunner:
         self.output.write(self.environ["JOB_ID"])
         self.output.seek(0)
 
+    def get_checkpoint(self):
+        return {"start_time": self.start_time, "exit_code": self.exit_code}
+
+    @classmethod
+    def restore(cls, working_dir, time_provider, command, checkpoint):
+        # pylint:disable=unused-argument
+        runner = cls.__new__(cls)
+        runner.time_provider = time_provider
+        runner.duration = IntervalSpec(command.split(None, 1)[0]).seconds - 1
+        runner.exit_code = checkpoint["exit_code"]
+        runner.start_time = checkpoint["start_time"]
+        runner.stop_time = runner.start_time + runner.duration
+        runner.usage = None
+        runner.time_provider.schedule_child_signal(runner.stop_time)
+        runner.output = tempfile.TemporaryFile(mode="w+")
+        return runner
+
     def wait(self):
         return self.exit_code
 
     def terminate(self):
-        self.stop_time = self.time_provider.now()
+        self.stop_time = self.time_provider.time()
         self.duration = self.stop_time - self.start_time
         self.exit_code = -1
         self.time_provider.schedule_child_signal(self.stop_time)
@@ -154,7 +175,7 @@ class TestRunner:
         pass
 
     def has_finished(self):
-        return self.time_provider.now() >= self.stop_time
+        return self.time_provider.time() >= self.stop_time
 
     def get_start_time(self):
         return self.start_time
@@ -181,16 +202,24 @@ class TestRunner:
 
 class TestMailer(Mailer):
 
-    def send(self, sendmail, mailto, directory, environ, text, output):
-        from .test_pcron import MailTest
+    def __init__(self, logger):
+        super().__init__(logger)
+        self.mail = collections.defaultdict(collections.Counter)
 
+    def send(self, sendmail, mailto, directory, environ, text, output, user=None):
         if output is None:
             output = ""
         else:
             output = output.read()
 
         message = email.message_from_string(text + "\n" + output)
-        MailTest().count(message)
+        self.count(message)
+
+    def count(self, m):
+        _, job_id = m["subject"].rsplit(None, 1)
+        job_name, _ = job_id.split("-", 1)
+
+        self.mail[m["pcron-status"]][job_name] += 1
 
 
 class TestJob(Job):
@@ -205,9 +234,10 @@ class TestScheduler(Scheduler):
     Job = TestJob
     Mailer = TestMailer
 
-    def __init__(self, time_provider, directory, logfile=None, persistent_state=True):
-        super().__init__(time_provider, directory, logfile, persistent_state)
+    def __init__(self, time_provider, directory, logfile=None, persistent_state=True, **kwargs):
+        super().__init__(time_provider, directory, logfile, persistent_state, **kwargs)
         self.counter = collections.Counter()
+        self.peak_running = 0
 
     def init_signal_handling(self):
         pass
@@ -224,4 +254,24 @@ class TestScheduler(Scheduler):
     def start_job(self, job):
         super().start_job(job)
         self.counter[job.name] += 1
+        self.peak_running = max(self.peak_running, len(self.running))
+
 
+
+class TestMultiScheduler(MultiScheduler):
+
+    Scheduler = TestScheduler
+
+    def init_signal_handling(self):
+        pass
+
+
+def load_script(name):
+    """Import one of the executable scripts from the top-level directory as
+       a module.
+    """
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), name)
+    loader = importlib.machinery.SourceFileLoader(name, path)
+    module = importlib.util.module_from_spec(importlib.util.spec_from_loader(name, loader))
+    loader.exec_module(module)
+    return module
@@ -0,0 +1,2 @@
+FOO=bar
+BAR="$FOO baz"
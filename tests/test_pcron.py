@@ -31,16 +31,37 @@ import unittest
 import tempfile
 import email
 import signal
+import select
+import errno
 import collections
+import unittest.mock
+import pwd
+import time
+import io
+import argparse
+import subprocess
+import resource
+import fcntl
+import pickle
 
 from libpcron.time import TimeSpec, TimeSpecError, IntervalSpec, \
-        IntervalSpecError, format_time
+        IntervalSpecError, format_time, to_seconds, to_datetime, to_posix, INFINITY
 from libpcron.scheduler import Scheduler
-from libpcron.parser import CrontabParser, CrontabError
-from libpcron.job import Job
+from libpcron.parser import CrontabParser, CalendarParser, CrontabError
+from libpcron.job import Job, JobQueue
 from libpcron.mail import Mailer
-
-from . import TestScheduler, TestJob, TestRunner, TestTimeProvider
+from libpcron.shared import NullLogger, Credentials, create_environ
+from libpcron import run
+from libpcron.run import Runner, RunnerError, format_usage, snapshot_environ, \
+        get_popen_options, raise_nofile_limit
+from libpcron.time import TimeProvider
+from libpcron.limit import SlotLimiter, LoadMonitor, create_slots
+from libpcron.linux import Inotify, TimerFD, IN_CREATE, IN_CLOSE_WRITE
+from libpcron.calendars import Calendar
+from libpcron.state import StateFile, StateError, read_state, write_state, MAGIC
+
+from . import TestScheduler, TestMultiScheduler, TestJob, TestRunner, TestTimeProvider, \
+        load_script
 
 data_directory = os.path.join(os.path.dirname(__file__), "data")
 
@@ -103,6 +124,12 @@ class TimeSpecTest(unittest.TestCase):
             else:
                 self.fail("TimeSpecError not raised for %r" % value)
 
+    def test_valid_seconds(self):
+        self._test_valid_values(TimeSpec.parse_second, 0, 60)
+
+    def test_invalid_seconds(self):
+        self._test_invalid_values(TimeSpec.parse_second, 0, 60)
+
     def test_valid_minutes(self):
         self._test_valid_values(TimeSpec.parse_minute, 0, 60)
 
@@ -161,10 +188,60 @@ class TimeSpecTest(unittest.TestCase):
             ("0 * * aug *",     dt(2010, 3, 7, 15, 0),  False),
             ("0 * * * sun",     dt(2010, 3, 7, 15, 0),  True),
             ("0 * * * sun-thu", dt(2010, 3, 8, 15, 0),  True),
+
+            ("*/15 * * * * *",  dt(2010, 3, 7, 15, 0, 45), True),
+            ("*/15 * * * * *",  dt(2010, 3, 7, 15, 0, 50), False),
+            ("0 0 * * * *",     dt(2010, 3, 7, 15, 0),  True),
+            ("* * * * *",       dt(2010, 3, 7, 15, 0, 1),  False),
         ]
         for value, ts,  success in values:
             t = TimeSpec(value)
-            self.assertEqual(t.match(ts), success, "TimeSpec(%r) did not match %r" % (value, ts))
+            self.assertEqual(t.match(to_seconds(ts)), success,
+                             "TimeSpec(%r) did not match %r" % (value, ts))
+
+    def test_timestamp_generator(self):
+        generator = TimeSpec("30 12 29 2 *").timestamp_generator(to_seconds(dt(2010, 3, 7, 16, 0)))
+        self.assertEqual([to_datetime(next(generator)) for _ in range(2)],
+                         [dt(2012, 2, 29, 12, 30), dt(2016, 2, 29, 12, 30)])
+
+        now = to_seconds(dt(2010, 3, 7, 16, 0, 1))
+        generator = TimeSpec("* 16 * * *").timestamp_generator(now)
+        self.assertEqual(to_datetime(next(generator)), dt(2010, 3, 7, 16, 1))
+
+        generator = TimeSpec("10,50 */30 16 * * *").timestamp_generator(now)
+        self.assertEqual([to_datetime(next(generator)) for _ in range(3)],
+                         [dt(2010, 3, 7, 16, 0, 10), dt(2010, 3, 7, 16, 0, 50),
+                          dt(2010, 3, 7, 16, 30, 10)])
+
+    def test_count(self):
+        start = to_seconds(dt(2011, 12, 30, 12, 7))
+        for value in ("* * * * *", "*/7 3-5 * * *", "0 0 29 2 *", "15 12 1,15 * mon", "0 * * jan sun",
+                      "*/10 0 3-5 * * *"):
+            t = TimeSpec(value)
+            for days in (0, 1, 3, 70):
+                stop = start + days * 86400 + 1234
+                generator = t.timestamp_generator(start)
+                expected = 0
+                while next(generator) < stop:
+                    expected += 1
+                self.assertEqual(t.count(start, stop), expected, "%r, %d days" % (value, days))
+
+        self.assertEqual(TimeSpec("* * * * *").count(start, start), 0)
+
+    def test_conversion(self):
+        for ts in (dt(1970, 1, 1), dt(1969, 12, 31, 23, 59, 59), dt(2038, 1, 19, 3, 14, 8)):
+            self.assertEqual(to_datetime(to_seconds(ts)), ts)
+        self.assertEqual(to_seconds(dt(1970, 1, 2, 0, 1)), 86460)
+        self.assertEqual(format_time(INFINITY), "--------/----")
+        self.assertEqual(format_time(86460), "19700102/0001")
+        self.assertEqual(format_time(86475), "19700102/000115")
+
+    def test_resolution(self):
+        self.assertEqual(TimeSpec("* * * * *").resolution, 60)
+        self.assertEqual(TimeSpec("0 * * * * *").resolution, 60)
+        self.assertEqual(TimeSpec("*/10 * * * * *").resolution, 1)
+        self.assertEqual(IntervalSpec("1h").resolution, 60)
+        self.assertEqual(IntervalSpec("90s").resolution, 1)
 
 
 class IntervalSpecTest(unittest.TestCase):
@@ -186,6 +263,8 @@ class IntervalSpecTest(unittest.TestCase):
         "1m1w1d1h1":    td(weeks=5, days=1, hours=1, minutes=1),
         "2m1d1h":       td(weeks=8, days=1, hours=1),
         "21d23":        td(weeks=3, minutes=23),
+        "15s":          td(seconds=15),
+        "1h30s":        td(hours=1, seconds=30),
     }
 
     def test_valid_intervals(self):
@@ -205,6 +284,137 @@ class FormatTest(unittest.TestCase):
         self.assertEqual(format_time(td(weeks=1, days=2, hours=3, minutes=4, seconds=5)), "9d3h4m5s")
 
 
+class RunnerTest(unittest.TestCase):
+
+    def test_usage(self):
+        environ = create_environ(pwd.getpwuid(os.getuid()))
+        with tempfile.TemporaryDirectory() as directory:
+            with Runner(directory, TimeProvider(), "exit 3", environ, "") as runner:
+                self.assertEqual(runner.wait(), 3)
+                self.assertTrue(runner.has_finished())
+                self.assertIsNotNone(runner.usage)
+                self.assertTrue(format_usage(runner.usage).startswith("utime="))
+
+    def test_restore(self):
+        environ = create_environ(pwd.getpwuid(os.getuid()))
+        with tempfile.TemporaryDirectory() as directory:
+            with Runner(directory, TimeProvider(), "sleep 1; echo done; exit 4", environ, "") as runner:
+                checkpoint = runner.get_checkpoint()
+
+                with self.assertRaises(RunnerError):
+                    Runner.restore(directory, TimeProvider(), runner.command,
+                                   dict(checkpoint, proc_start=checkpoint["proc_start"] + 1))
+
+                with Runner.restore(directory, TimeProvider(), runner.command, checkpoint) as adopted:
+                    self.assertFalse(adopted.has_finished())
+                    self.assertEqual(adopted.wait(), 4)
+                    self.assertIsNotNone(adopted.usage)
+                    adopted.finalize()
+                    self.assertEqual(adopted.output.read(), b"done\n")
+                    self.assertEqual(adopted.start_time, runner.start_time)
+
+                # The process has been reaped through the adopted runner.
+                runner.process.returncode = adopted.returncode
+
+    def test_snapshot(self):
+        environ = create_environ(pwd.getpwuid(os.getuid()))
+        with tempfile.TemporaryDirectory() as directory:
+            snapshot = snapshot_environ(directory, environ, "FOO=bar")
+            self.assertEqual(snapshot["FOO"], "bar")
+
+            # A background process that holds on to the output must not
+            # keep us waiting either.
+            start = time.monotonic()
+            with self.assertRaisesRegex(RunnerError, r"within 1 seconds"):
+                snapshot_environ(directory, environ, "sleep 60 & sleep 60", timeout=1)
+            self.assertLess(time.monotonic() - start, 10)
+
+    def test_nofile_limit(self):
+        self.addCleanup(resource.setrlimit, resource.RLIMIT_NOFILE,
+                        resource.getrlimit(resource.RLIMIT_NOFILE))
+        self.addCleanup(setattr, run, "child_nofile_limit", None)
+
+        limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if limit[1] == resource.RLIM_INFINITY:
+            self.skipTest("there is no hard limit")
+        if limit[0] == limit[1]:
+            limit = (limit[1] // 2, limit[1])
+            resource.setrlimit(resource.RLIMIT_NOFILE, limit)
+
+        self.assertEqual(raise_nofile_limit(), limit[1])
+        self.assertEqual(resource.getrlimit(resource.RLIMIT_NOFILE), (limit[1], limit[1]))
+
+        # Child processes get the original limit.
+        output = subprocess.check_output([sys.executable, "-c",
+                                          "import resource; "
+                                          "print(resource.getrlimit(resource.RLIMIT_NOFILE)[0])"],
+                                         **get_popen_options(None))
+        self.assertEqual(int(output), limit[0])
+
+    @unittest.skipUnless(os.geteuid() == 0, "requires superuser privileges")
+    def test_credentials(self):
+        try:
+            record = pwd.getpwnam("nobody")
+        except KeyError:
+            self.skipTest("user nobody does not exist")
+        record = pwd.struct_passwd(record[:6] + ("/bin/sh",))
+
+        with tempfile.TemporaryDirectory() as directory:
+            os.chmod(directory, 0o777)
+            with Credentials(record):
+                self.assertEqual(os.geteuid(), record.pw_uid)
+                with Runner(os.path.join(directory, "job"), TimeProvider(), "id -ru; id -rg",
+                            create_environ(record), "", user=record) as runner:
+                    self.assertEqual(runner.wait(), 0)
+                    runner.finalize()
+                    self.assertEqual(runner.output.read().split(),
+                                     [str(record.pw_uid).encode(), str(record.pw_gid).encode()])
+                self.assertEqual(os.stat(os.path.join(directory, "job")).st_uid, record.pw_uid)
+
+            self.assertEqual(os.geteuid(), 0)
+
+
+class SendmailTest(unittest.TestCase):
+
+    text = "Subject: test\n\n"
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.sendmail = os.path.join(self.directory.name, "sendmail")
+        self.mailbox = os.path.join(self.directory.name, "mailbox")
+
+        with open(self.sendmail, "w") as fobj:
+            fobj.write("#!/bin/sh\ncat > \"$1\"\n")
+        os.chmod(self.sendmail, 0o755)
+
+        # Produce a multi-megabyte job output.
+        self.output = tempfile.TemporaryFile(dir=self.directory.name)
+        for i in range(100000):
+            self.output.write(b"line %08d of the job output\n" % i)
+        self.output.flush()
+        self.output.seek(0)
+
+    def tearDown(self):
+        self.output.close()
+        self.directory.cleanup()
+
+    def _test(self):
+        mailer = Mailer(NullLogger())
+        mailer.send(self.sendmail, self.mailbox, self.directory.name, dict(os.environ),
+                    self.text, self.output)
+
+        self.output.seek(0)
+        with open(self.mailbox, "rb") as fobj:
+            self.assertEqual(fobj.read(), self.text.encode(mailer.encoding) + self.output.read())
+
+    def test_sendfile(self):
+        self._test()
+
+    def test_fallback(self):
+        with unittest.mock.patch("os.sendfile", side_effect=OSError(errno.EINVAL, "")):
+            self._test()
+
+
 class CrontabTest(unittest.TestCase):
 
     def _test(self, name):
@@ -217,6 +427,32 @@ class CrontabTest(unittest.TestCase):
         self.assertRaises(CrontabError, self._test, "crontab2.ini")
         self.assertRaises(CrontabError, self._test, "crontab3.ini")
         self.assertRaises(CrontabError, self._test, "crontab4.ini")
+        self.assertRaises(CrontabError, self._test, "crontab6.ini")
+        self.assertRaises(CrontabError, self._test, "crontab8.ini")
+        self.assertRaises(CrontabError, self._test, "crontab9.ini")
+        self.assertRaises(CrontabError, self._test, "crontab10.ini")
+
+    def test_positions(self):
+        with self.assertRaisesRegex(CrontabError, r"crontab10\.ini:3: minute value 61"):
+            self._test("crontab10.ini")
+        with self.assertRaisesRegex(CrontabError, r"crontab3\.ini:4: invalid choice"):
+            self._test("crontab3.ini")
+        with self.assertRaisesRegex(CrontabError, r"crontab4\.ini:3: variable 'invalid'"):
+            self._test("crontab4.ini")
+        with self.assertRaisesRegex(CrontabError, r"crontab6\.ini:\d+: variable 'environment'"):
+            self._test("crontab6.ini")
+
+    def test_dialect(self):
+        directory = os.path.join(data_directory, "crontabs")
+        parser = CrontabParser(os.path.join(directory, "crontab11.ini"), TestJob)
+        startup, jobs = parser.parse()
+
+        self.assertEqual(list(jobs), ["foo", "foo.bar"])
+        self.assertEqual(jobs["foo"].command, "echo foo\necho bar\n\necho baz")
+        self.assertEqual(jobs["foo.bar"].command, jobs["foo"].command)
+        self.assertEqual(jobs["foo.bar"].mail, "never")
+        self.assertEqual(jobs["foo.bar"].queue, "foo")
+        self.assertEqual(parser.settings["loglevel"], "debug")
 
     def test_inheritance(self):
         startup, jobs = self._test("crontab5.ini")
@@ -227,6 +463,31 @@ class CrontabTest(unittest.TestCase):
         self.assertEqual(jobs["foo.baz"].command, "baz")
         self.assertEqual(jobs["foo"].time, jobs["foo.baz"].time)
 
+    def test_definition(self):
+        startup, jobs = self._test("crontab5.ini")
+
+        definition = jobs["foo.bar"]
+        self.assertFalse(hasattr(definition, "__dict__"))
+        definition.init(TimeProvider(), NullLogger(), "/tmp", "", {"USER": "alice"})
+
+        job = definition("time")
+        self.assertIsInstance(job, TestJob)
+        self.assertIs(job.definition, definition)
+        self.assertEqual(job.command, "foo")
+        self.assertEqual(job.username, "alice")
+        self.assertEqual(definition.last_run, job.this_run)
+
+    def test_limits(self):
+        startup, jobs = self._test("crontab7.ini")
+
+        self.assertEqual(jobs["foo"].get_wrapper(), [
+            "prlimit", "--cpu=3600", "--as=536870912", "--nofile=1024",
+            "nice", "-n", "10", "ionice", "-c", "2", "-n", "7", "taskset", "-c", "0-1,3"])
+        self.assertEqual(jobs["foo.bar"].get_wrapper(), [
+            "prlimit", "--cpu=3600", "--as=1073741824", "--nofile=1024",
+            "nice", "-n", "10", "ionice", "-c", "3", "taskset", "-c", "0-1,3"])
+        self.assertEqual(jobs["baz"].get_wrapper(), [])
+
 
 class _SchedulerTest(unittest.TestCase):
 
@@ -327,6 +588,41 @@ class SchedulerTest(_SchedulerTest):
         self.assertEqual(self.counter["quux"], 520)
         self.assertEqual(self.counter["corge"], 1)
 
+    def test_environment(self):
+        self._test("test_environment", stop=dt(1970, 1, 5, 0, 59, 59))
+
+        self.assertEqual(self.counter["foo"], 4)
+        self.assertEqual(self.scheduler.init_code, "")
+        self.assertEqual(self.scheduler.environ["FOO"], "bar")
+        self.assertEqual(self.scheduler.environ["BAR"], "bar baz")
+        self.assertEqual(self.scheduler.environ["PCRONDIR"],
+                         os.path.join(os.path.abspath(data_directory), "test_environment"))
+
+    def test_splay(self):
+        names = ("foo", "bar", "baz", "qux", "quux", "corge")
+
+        self._test("test_splay")
+        offsets = dict((name, self.scheduler.crontab[name].splay_offset) for name in names)
+
+        for name in names:
+            self.assertEqual(self.counter[name], 24)
+
+        self.assertGreater(len(set(offsets.values())), 1)
+        self.assertTrue(all(offset < 3600 for offset in offsets.values()))
+        self.assertLess(offsets["corge"], 600)
+
+        # The offsets must be the same with every run.
+        self._test("test_splay")
+        for name in names:
+            self.assertEqual(self.scheduler.crontab[name].splay_offset, offsets[name])
+
+    def test_slots(self):
+        self._test("test_slots")
+
+        self.assertEqual(self.scheduler.peak_running, 2)
+        for name in ("foo", "bar", "baz", "qux"):
+            self.assertEqual(self.counter[name], 24)
+
     def test_special(self):
         self._test("test_special")
 
@@ -347,15 +643,9 @@ class SchedulerTest(_SchedulerTest):
 
 class MailTest(_SchedulerTest):
 
-    def __new__(cls, *args):
-        # Produce the same instance for every call. We use this in TestMailer,
-        # to call e.g. the count_killed() method.
-        if not hasattr(cls, "_instance"):
-            cls._instance = super().__new__(cls)
-        return cls._instance
-
-    def setUp(self):
-        self.mail = {}
+    @property
+    def mail(self):
+        return self.scheduler.mailer.mail
 
     def test_mail(self):
         self._test("test_mail", stop=dt(1970, 1, 5, 1, 0, 0))
@@ -391,11 +681,355 @@ class MailTest(_SchedulerTest):
         self.assertEqual(self.mail["ERROR"]["quux.2"], 1)
         self.assertEqual(self.mail["ERROR"]["quux.3"], 0)
 
-    def count(self, m):
-        _, job_id = m["subject"].rsplit(None, 1)
-        job_name, _ = job_id.split("-", 1)
+    def test_timeout(self):
+        self._test("test_timeout", stop=dt(1970, 1, 5, 1, 59, 0))
+
+        self.assertEqual(self.counter["foo"], 2)
+        self.assertEqual(self.mail["TIMEOUT"]["foo"], 2)
+        self.assertEqual(self.mail["INFO"]["foo"], 0)
+
+        self.assertEqual(self.counter["bar"], 2)
+        self.assertEqual(self.mail["TIMEOUT"]["bar"], 0)
+        self.assertEqual(self.mail["INFO"]["bar"], 2)
+
+        self.assertEqual(self.counter["baz"], 2)
+        self.assertEqual(self.mail["TIMEOUT"]["baz"], 0)
+        self.assertEqual(self.mail["INFO"]["baz"], 2)
+
+
+class SlotLimiterTest(_SchedulerTest):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        create_slots(self.directory.name, 2)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_slots(self):
+        limiter = SlotLimiter(self.directory.name, "foo", NullLogger().new("limit"))
+        self.assertTrue(limiter.acquire("a"))
+        self.assertTrue(limiter.acquire("b"))
+        self.assertFalse(limiter.acquire("c"))
+        limiter.release("a")
+        self.assertTrue(limiter.acquire("c"))
+        self.assertEqual(limiter.get_usage(), (2, 2))
+
+    def test_fair_share(self):
+        limiter1 = SlotLimiter(self.directory.name, "foo", NullLogger().new("limit"))
+        limiter2 = SlotLimiter(self.directory.name, "bar", NullLogger().new("limit"))
+
+        # As long as foo is the only user it may take all slots.
+        self.assertTrue(limiter1.acquire("a"))
+        self.assertTrue(limiter1.acquire("b"))
+        self.assertFalse(limiter2.acquire("c"))
+
+        # Now that bar is waiting, foo must not take more than its share.
+        limiter1.release("a")
+        self.assertFalse(limiter1.acquire("a"))
+        self.assertTrue(limiter2.acquire("c"))
+
+        # If bar is idle again, foo may take all slots.
+        limiter2.release("c")
+        limiter2.set_active(False)
+        self.assertTrue(limiter1.acquire("a"))
+
+    def test_contention(self):
+        limiter = SlotLimiter(self.directory.name, "foo", NullLogger().new("limit"))
+        limiter.set_active(False)
+
+        # Another instance counts the active users while we try to register.
+        fd = os.open(limiter.user_path, os.O_RDONLY | os.O_CREAT, 0o444)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            self.assertFalse(limiter.acquire("a"))
+            self.assertTrue(limiter.available)
+        finally:
+            os.close(fd)
+
+        self.assertTrue(limiter.acquire("a"))
+        self.assertEqual(limiter.get_usage(), (1, 2))
+
+    def test_rounding(self):
+        create_slots(self.directory.name, 8)
+        limiters = [SlotLimiter(self.directory.name, name, NullLogger().new("limit"))
+                    for name in ("foo", "bar", "baz")]
+        for limiter in limiters:
+            limiter.set_active(True)
+
+        # Three users share eight slots, none of them remains unused.
+        taken = []
+        for limiter in limiters:
+            count = 0
+            while limiter.acquire(count):
+                count += 1
+            taken.append(count)
+        self.assertEqual(taken, [3, 3, 2])
+
+    def test_foreign_user_file(self):
+        limiter = SlotLimiter(self.directory.name, "foo", NullLogger().new("limit"))
+        with open(limiter.user_path, "w"):
+            pass
+
+        # Someone else has created the file and might hold a lock on it.
+        with unittest.mock.patch("os.geteuid", return_value=os.geteuid() + 1):
+            for key in "abc":
+                self.assertTrue(limiter.acquire(key))
+        self.assertFalse(limiter.available)
+
+    def test_locked_user_file(self):
+        limiter = SlotLimiter(self.directory.name, "foo", NullLogger().new("limit"))
+        fd = os.open(limiter.user_path, os.O_RDONLY | os.O_CREAT, 0o444)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            with unittest.mock.patch.object(SlotLimiter, "REGISTER_TIMEOUT", 0):
+                self.assertFalse(limiter.acquire("a"))
+                # The file stays locked, there is no limit then.
+                self.assertTrue(limiter.acquire("a"))
+                self.assertFalse(limiter.available)
+        finally:
+            os.close(fd)
+
+        self.assertTrue(limiter.acquire("b"))
+        self.assertTrue(limiter.available)
+
+    def test_unavailable(self):
+        limiter = SlotLimiter(os.path.join(self.directory.name, "missing"), "foo",
+                              NullLogger().new("limit"))
+        for key in "abc":
+            self.assertTrue(limiter.acquire(key))
+
+    def test_scheduler(self):
+        self.time_provider = self.TimeProvider()
+        directory = os.path.join(data_directory, "test_slots")
+
+        with open(os.path.join(directory, "logfile.txt"), "w") as self.logfile:
+            with self.Scheduler(self.time_provider, os.path.abspath(directory), self.logfile,
+                                persistent_state=False,
+                                slot_directory=self.directory.name) as self.scheduler:
+                self.scheduler.settings["max_running"] = 0
+                self.scheduler.mainloop()
+
+        self.assertEqual(self.scheduler.peak_running, 2)
+        for name in ("foo", "bar", "baz", "qux"):
+            self.assertEqual(self.counter[name], 24)
+
+
+class MultiSchedulerTest(unittest.TestCase):
+
+    def test_multi(self):
+        time_provider = TestTimeProvider()
+        directory = os.path.join(data_directory, "test_multi")
+        current = pwd.getpwuid(os.getuid())
+
+        with open(os.path.join(directory, "logfile.txt"), "w") as logfile:
+            schedulers = TestMultiScheduler(time_provider, NullLogger().new("multi"))
+            for name in ("alice", "bob"):
+                record = pwd.struct_passwd((name,) + current[1:])
+                schedulers.add(record, os.path.abspath(os.path.join(directory, name)),
+                               logfile=logfile, persistent_state=False)
+
+            alice = schedulers.schedulers["alice"][1]
+            bob = schedulers.schedulers["bob"][1]
+            schedulers.mainloop()
+
+        self.assertEqual(alice.counter, {"foo": 24, "bar": 12})
+        self.assertEqual(bob.counter, {"foo": 8})
+        self.assertEqual(alice.crontab["foo"].username, "alice")
+        self.assertEqual(bob.crontab["foo"].mailto, "bob")
+
+    def test_reboot(self):
+        current = pwd.getpwuid(os.getuid())
+        record = pwd.struct_passwd(("alice",) + current[1:])
+
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "crontab.ini"), "w") as fobj:
+                fobj.write("[default]\nmail: never\ncommand: 1 0\n\n"
+                           "[boot]\ntime: @reboot\n\n[noon]\ntime: 0 12 * * *\n")
+
+            time_provider = TestTimeProvider(dt(1970, 1, 5, 0, 0), dt(1970, 1, 5, 0, 30))
+            schedulers = TestMultiScheduler(time_provider, NullLogger().new("multi"))
+            schedulers.add(record, directory, persistent_state=False)
+            scheduler = schedulers.schedulers["alice"][1]
+            schedulers.mainloop()
+            scheduler.logfile.close()
+
+        # The @reboot job must not wait for the job at noon.
+        self.assertEqual(scheduler.counter, {"boot": 1})
+
+    def test_failure(self):
+        time_provider = TestTimeProvider()
+        directory = os.path.join(data_directory, "test_multi")
+        current = pwd.getpwuid(os.getuid())
+
+        with open(os.path.join(directory, "logfile.txt"), "w") as logfile:
+            schedulers = TestMultiScheduler(time_provider, NullLogger().new("multi"))
+            for name in ("alice", "bob"):
+                record = pwd.struct_passwd((name,) + current[1:])
+                schedulers.add(record, os.path.abspath(os.path.join(directory, name)),
+                               logfile=logfile, persistent_state=False)
+
+            bob = schedulers.schedulers["bob"][1]
+            with unittest.mock.patch.object(schedulers.schedulers["alice"][1], "step",
+                                            side_effect=RuntimeError):
+                schedulers.mainloop()
+
+        # Only alice's scheduler is dropped, and the caller is told so once.
+        self.assertEqual(list(schedulers.schedulers), ["bob"])
+        self.assertEqual(bob.counter, {"foo": 8})
+        self.assertEqual(schedulers.pop_failed(), ["alice"])
+        self.assertEqual(schedulers.pop_failed(), [])
+
+
+class TestLoadMonitor(LoadMonitor):
+
+    def read(self):
+        return {"load1": 5.0, "load5": 3.0, "load15": 1.0, "cpu": 10.0}
+
+
+class LoadScheduler(TestScheduler):
+
+    LoadMonitor = TestLoadMonitor
+
 
-        self.mail.setdefault(m["pcron-status"], collections.Counter())[job_name] += 1
+class LoadTest(_SchedulerTest):
+
+    Scheduler = LoadScheduler
+
+    def test_load_monitor(self):
+        with tempfile.TemporaryDirectory() as directory:
+            os.mkdir(os.path.join(directory, "pressure"))
+            with open(os.path.join(directory, "loadavg"), "w") as fobj:
+                fobj.write("0.79 0.69 0.42 1/71 30926\n")
+            with open(os.path.join(directory, "pressure", "io"), "w") as fobj:
+                fobj.write("some avg10=3.89 avg60=9.58 avg300=9.17 total=90368865\n"\
+                           "full avg10=1.00 avg60=0.00 avg300=0.00 total=0\n")
+
+            monitor = LoadMonitor(directory)
+            self.assertEqual(monitor.get_values(),
+                             {"load1": 0.79, "load5": 0.69, "load15": 0.42, "io": 3.89})
+            self.assertEqual(len(monitor.get_exceeded([("load1", 0.5), ("io", 5), ("cpu", 0)])), 1)
+
+    def test_deferral(self):
+        self._test("test_load")
+
+        self.assertEqual(self.counter["foo"], 24)
+        self.assertEqual(self.counter["bar"], 0)
+        self.assertEqual(self.counter["baz"], 24)
+
+
+class TimeProviderTest(unittest.TestCase):
+
+    def test_sleep_fds(self):
+        rfd, wfd = os.pipe()
+        try:
+            os.write(wfd, b"x")
+            start = time.monotonic()
+            self.assertIsNone(TimeProvider().sleep(5, [rfd]))
+            self.assertLess(time.monotonic() - start, 1)
+        finally:
+            os.close(rfd)
+            os.close(wfd)
+
+
+    def test_sleep_until(self):
+        time_provider = TimeProvider()
+        deadline = time_provider.time() + 2
+        self.assertIsNone(time_provider.sleep_until(deadline))
+        self.assertGreaterEqual(time_provider.time(), deadline)
+        self.assertLess(time_provider.time(), deadline + 1)
+
+    def test_timerfd(self):
+        try:
+            timerfd = TimerFD()
+        except OSError as exc:
+            self.skipTest("timerfd is not available: %s" % exc)
+
+        with timerfd:
+            self.assertIsNone(timerfd.read())
+            timerfd.set(time.time() + 0.2)
+            self.assertIsNone(timerfd.read())
+            poll = select.poll()
+            poll.register(timerfd, select.POLLIN)
+            self.assertEqual(len(poll.poll(5000)), 1)
+            self.assertTrue(timerfd.read())
+
+            # A deadline in the past expires immediately.
+            timerfd.set(time.time() - 60)
+            self.assertTrue(timerfd.read())
+
+    def test_posix(self):
+        now = int(time.time())
+        self.assertEqual(to_posix(now + time.localtime(now).tm_gmtoff), now)
+
+
+class ReloadTimeProvider(TestTimeProvider):
+
+    def __init__(self, change_time, change, **kwargs):
+        super().__init__(**kwargs)
+        self.change_time = change_time
+        self.change = change
+
+    def sleep(self, seconds, fds=()):
+        signum = super().sleep(seconds, fds)
+        if self.change is not None and self.now() >= self.change_time:
+            self.change()
+            self.change = None
+        return signum
+
+
+class ReloadTest(unittest.TestCase):
+
+    crontab = "[default]\nmail: never\nloglevel: debug\ncommand: 30 0\ntime: @hourly\n\n[foo]\n"
+
+    def test_reload(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "crontab.ini")
+            with open(path, "w") as fobj:
+                fobj.write(self.crontab)
+
+            def change():
+                # Replace the crontab like an editor or pcrontab would.
+                with open(path + ".tmp", "w") as fobj:
+                    fobj.write(self.crontab + "\n[bar]\n")
+                os.rename(path + ".tmp", path)
+
+            time_provider = ReloadTimeProvider(dt(1970, 1, 5, 12, 0), change)
+            with TestScheduler(time_provider, directory, persistent_state=False) as scheduler:
+                self.assertIsNotNone(scheduler.watcher)
+                scheduler.mainloop()
+                scheduler.logfile.close()
+
+            with open(os.path.join(directory, "logfile.txt")) as fobj:
+                reloads = [line for line in fobj if "configuration has changed" in line]
+
+        self.assertEqual(len(reloads), 1)
+        self.assertEqual(scheduler.counter["foo"], 24)
+        self.assertEqual(scheduler.counter["bar"], 11)
+
+
+class InotifyTest(unittest.TestCase):
+
+    def test_inotify(self):
+        with tempfile.TemporaryDirectory() as directory:
+            try:
+                inotify = Inotify()
+            except OSError as exc:
+                self.skipTest("inotify is not available: %s" % exc)
+
+            with inotify:
+                wd = inotify.add_watch(directory, IN_CREATE | IN_CLOSE_WRITE)
+                self.assertEqual(inotify.read(), [])
+
+                with open(os.path.join(directory, "crontab.ini"), "w"):
+                    pass
+
+                events = [(w, mask, name) for w, mask, _, name in inotify.read()]
+                self.assertEqual(events, [(wd, IN_CREATE, "crontab.ini"),
+                                          (wd, IN_CLOSE_WRITE, "crontab.ini")])
+
+                with self.assertRaises(FileNotFoundError):
+                    inotify.add_watch(os.path.join(directory, "missing"), IN_CREATE)
 
 
 class PersistenceTest(_SchedulerTest):
@@ -432,6 +1066,586 @@ class PersistenceTest(_SchedulerTest):
         self.assertEqual(self.counter["foo"], 4)
 
 
+
+class SecondsTest(unittest.TestCase):
+
+    crontab = "[default]\nmail: never\ncommand: 5s 0\n\n" \
+              "[time]\ntime: */15 * * * * *\n\n[interval]\ninterval: 10s\n\n" \
+              "[minute]\ntime: * * * * *\n"
+
+    def test_seconds(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "crontab.ini"), "w") as fobj:
+                fobj.write(self.crontab)
+
+            time_provider = TestTimeProvider(dt(1970, 1, 5, 8, 59, 59), dt(1970, 1, 5, 9, 59, 59))
+            with TestScheduler(time_provider, directory) as scheduler:
+                self.assertEqual(scheduler.crontab["time"].next_run, to_seconds(dt(1970, 1, 5, 9, 0)))
+                self.assertEqual(scheduler.crontab["interval"].next_run,
+                                 to_seconds(dt(1970, 1, 5, 9, 0)))
+                scheduler.mainloop()
+                scheduler.logfile.close()
+
+            self.assertEqual(scheduler.counter["time"], 240)
+            self.assertEqual(scheduler.counter["interval"], 360)
+            self.assertEqual(scheduler.counter["minute"], 60)
+
+            with open(os.path.join(directory, "state.db"), "rb") as fobj:
+                state, _ = read_state(fobj)
+            self.assertEqual(state["time"], to_seconds(dt(1970, 1, 5, 10, 0)))
+            self.assertEqual(state["interval"], to_seconds(dt(1970, 1, 5, 10, 0)))
+
+    def test_splay(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "crontab.ini"), "w") as fobj:
+                fobj.write("[default]\nmail: never\ncommand: 1 0\ntime: @hourly\n\n"
+                           "[foo]\nsplay: 30s\n\n[bar]\nsplay: 90s\n")
+
+            time_provider = TestTimeProvider(dt(1970, 1, 5, 8, 59, 59), dt(1970, 1, 5, 11, 59, 59))
+            with TestScheduler(time_provider, directory) as scheduler:
+                offsets = dict((name, scheduler.crontab[name].splay_offset)
+                               for name in ("foo", "bar"))
+                scheduler.mainloop()
+                scheduler.logfile.close()
+
+        self.assertLess(offsets["foo"], 30)
+        self.assertLess(offsets["bar"], 90)
+        for name, offset in offsets.items():
+            self.assertEqual(scheduler.crontab[name].last_run,
+                             to_seconds(dt(1970, 1, 5, 11, 0)) + offset)
+            self.assertEqual(scheduler.counter[name], 3)
+
+
+class QueueWidthScheduler(TestScheduler):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.overlap = False
+
+    def start_job(self, job):
+        # A job must not run twice at the same time.
+        if any(j.name == job.name for j in self.running.values()):
+            self.overlap = True
+        super().start_job(job)
+
+
+class QueueWidthTest(unittest.TestCase):
+
+    crontab = "[default]\nmail: never\ncommand: 30 0\ntime: @hourly\nqueue: etl\n\n" \
+              "[s1]\nqueue_width: 4\n\n[s2]\n\n[s3]\n\n[s4]\n\n[s5]\n\n[s6]\n\n" \
+              "[slow]\ncommand: 90 0\nqueue: other\nqueue_width: 2\n\n" \
+              "[fast]\nqueue: other\n"
+
+    def test_width(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "crontab.ini"), "w") as fobj:
+                fobj.write(self.crontab)
+
+            time_provider = TestTimeProvider(dt(1970, 1, 5, 8, 59, 59), dt(1970, 1, 5, 11, 59, 59))
+            with QueueWidthScheduler(time_provider, directory) as scheduler:
+                self.assertEqual(scheduler.queue_widths, {"etl": 4, "other": 2})
+                scheduler.mainloop()
+                scheduler.logfile.close()
+
+        # Four of the six shards and slow and fast run at the same time.
+        self.assertEqual(scheduler.peak_running, 6)
+        for name in ("s1", "s2", "s3", "s4", "s5", "s6", "fast"):
+            self.assertEqual(scheduler.counter[name], 3, name)
+        # The runs of slow at 10:00 and 11:00 wait for the previous one.
+        self.assertEqual(scheduler.counter["slow"], 3)
+        self.assertFalse(scheduler.overlap)
+
+
+class PriorityScheduler(TestScheduler):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.order = []
+
+    def start_job(self, job):
+        if not self.order:
+            self.dump()
+        self.order.append(job.name)
+        super().start_job(job)
+
+
+class PriorityTest(unittest.TestCase):
+
+    crontab = "[default]\nmail: never\nloglevel: info\ncommand: 10 0\ntime: 0 9 * * *\n" \
+              "queue: shared\n\n[cleanup1]\n\n[cleanup2]\npriority: 1\n\n[cleanup3]\n\n" \
+              "[billing]\npriority: 10\n"
+
+    def test_queue(self):
+        queue = JobQueue()
+        Run = collections.namedtuple("Run", "name this_run priority")
+        runs = [Run("a", 1000, 0), Run("b", 1000, 0), Run("c", 1060, 1), Run("d", 1000, -1),
+                Run("e", 1000 - JobQueue.AGING, -1)]
+        for run in runs:
+            queue.push(run)
+
+        # c has the highest priority, e has waited long enough to catch up
+        # with a and b, but comes after them.
+        self.assertEqual([run.name for run in queue], ["c", "a", "b", "e", "d"])
+        self.assertEqual(queue.peek().name, "c")
+        self.assertEqual(len(queue), 5)
+
+        queue.remove(runs[1])
+        queue.remove(runs[2])
+        self.assertEqual([run.name for run in queue], ["a", "e", "d"])
+        with self.assertRaises(ValueError):
+            queue.remove(runs[1])
+
+    def test_scheduler(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "crontab.ini"), "w") as fobj:
+                fobj.write(self.crontab)
+
+            time_provider = TestTimeProvider(dt(1970, 1, 5, 8, 59, 59), dt(1970, 1, 5, 9, 59, 59))
+            with PriorityScheduler(time_provider, directory) as scheduler:
+                scheduler.mainloop()
+                scheduler.logfile.close()
+
+            with open(os.path.join(directory, "logfile.txt")) as fobj:
+                waiting = [line.split()[-1] if "priority" not in line else line.split()[-3]
+                           for line in fobj if "[waiting]" in line]
+
+        self.assertEqual(scheduler.order, ["billing", "cleanup2", "cleanup1", "cleanup3"])
+        self.assertEqual(waiting, ["cleanup2", "cleanup1", "cleanup3"])
+
+
+class CalendarTest(unittest.TestCase):
+
+    calendars = "[holidays]\ndates: 01-01 12-24..12-26\n    1970-01-07, 1970-01-09..1970-01-10\n\n" \
+                "[leap]\ndates: 02-29\n"
+
+    crontab = "[default]\nmail: never\ncommand: 1 0\ntime: 0 9 * * *\n\n" \
+              "[plain]\n\n[holiday]\ncalendar: holidays\n\n[again]\ncalendar: holidays\n\n" \
+              "[both]\ncalendar: holidays leap\n"
+
+    def test_calendar(self):
+        calendar = Calendar.parse("holidays", "01-01 12-24..12-26 2024-12-30..2025-01-02")
+        for date in (datetime.date(2023, 1, 1), datetime.date(2023, 12, 25),
+                     datetime.date(2024, 12, 31), datetime.date(2025, 1, 2)):
+            self.assertIn(date, calendar)
+        for date in (datetime.date(2023, 1, 2), datetime.date(2023, 12, 27),
+                     datetime.date(2024, 12, 29), datetime.date(2025, 1, 3)):
+            self.assertNotIn(date, calendar)
+
+        leap = Calendar.parse("leap", "02-29")
+        self.assertIn(datetime.date(2024, 2, 29), leap)
+        self.assertEqual(leap.get_bitmap(2023), 0)
+
+        combined = Calendar.combine([calendar, leap])
+        self.assertIn(datetime.date(2024, 2, 29), combined)
+        self.assertIn(datetime.date(2024, 12, 25), combined)
+
+        for value in ("13-01", "2025-02-30", "12-26..12-24", "2025-01-01..01-03", "tomorrow"):
+            with self.assertRaises(CrontabError, msg=value):
+                Calendar.parse("invalid", value)
+
+    def test_timespec(self):
+        calendar = Calendar.parse("holidays", "12-24..12-31 2012-01-02")
+        timespec = TimeSpec("0 12 * * mon-fri")
+        start = to_seconds(dt(2011, 12, 22))
+        generator = timespec.timestamp_generator(start, calendar)
+        self.assertEqual([to_datetime(next(generator)) for _ in range(3)],
+                         [dt(2011, 12, 22, 12), dt(2011, 12, 23, 12), dt(2012, 1, 3, 12)])
+
+        stop = start + 70 * 86400
+        generator = timespec.timestamp_generator(start, calendar)
+        expected = 0
+        while next(generator) < stop:
+            expected += 1
+        self.assertEqual(timespec.count(start, stop, calendar), expected)
+
+        # A calendar that leaves no day ends the schedule.
+        generator = timespec.timestamp_generator(start, Calendar.parse("all", "01-01..12-31"))
+        self.assertEqual(list(generator), [])
+
+    def test_scheduler(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "calendars.ini"), "w") as fobj:
+                fobj.write(self.calendars)
+            with open(os.path.join(directory, "crontab.ini"), "w") as fobj:
+                fobj.write(self.crontab)
+
+            time_provider = TestTimeProvider(dt(1970, 1, 4, 23, 59, 59), dt(1970, 1, 11, 23, 59, 59))
+            with TestScheduler(time_provider, directory) as scheduler:
+                # Jobs with the same calendars share the bitmaps.
+                self.assertIs(scheduler.crontab["holiday"].days_off,
+                              scheduler.crontab["again"].days_off)
+                self.assertIsNone(scheduler.crontab["plain"].days_off)
+                scheduler.mainloop()
+                scheduler.logfile.close()
+
+        self.assertEqual(scheduler.counter["plain"], 7)
+        self.assertEqual(scheduler.counter["holiday"], 4)
+        self.assertEqual(scheduler.counter["again"], 4)
+        self.assertEqual(scheduler.counter["both"], 4)
+
+    def test_errors(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "calendars.ini")
+            with open(path, "w") as fobj:
+                fobj.write("[holidays]\ndates: 01-01\n    12-32\n")
+            with self.assertRaisesRegex(CrontabError, r":2: invalid date:'12-32'"):
+                CalendarParser(path).parse()
+
+            with open(path, "w") as fobj:
+                fobj.write("[holidays]\ntime: 0 0 * * *\n")
+            with self.assertRaisesRegex(CrontabError, r":2: variable 'time' not allowed"):
+                CalendarParser(path).parse()
+
+            with open(os.path.join(directory, "crontab.ini"), "w") as fobj:
+                fobj.write("[foo]\ncommand: 1 0\ntime: @daily\ncalendar: holidays\n")
+            with self.assertRaisesRegex(CrontabError, r"crontab.ini:4: calendar holidays not found"):
+                CrontabParser(os.path.join(directory, "crontab.ini"), TestJob, {}).parse()
+
+    def test_pcrontab(self):
+        pcrontab = load_script("pcrontab")
+        crontab = "[foo]\ncommand: 1 0\ntime: @daily\ncalendar: holydays\n"
+
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "calendars.ini"), "w") as fobj:
+                fobj.write("[holidays]\ndates: 12-25\n")
+
+            # A misspelled calendar is rejected before the crontab is installed.
+            args = argparse.Namespace(directory=directory, action="import", no_backup=True)
+            with unittest.mock.patch("sys.stdin", io.StringIO(crontab)), \
+                    unittest.mock.patch("sys.stdout", io.StringIO()) as stdout:
+                pcrontab.edit_file(args, "crontab.ini")
+            self.assertIn("crontab.tmp.ini:4: calendar holydays not found", stdout.getvalue())
+            self.assertFalse(os.path.exists(os.path.join(directory, "crontab.ini")))
+
+
+class CatchUpTest(unittest.TestCase):
+
+    crontab = "[default]\nmail: never\ncommand: 1 0\n\n" \
+              "[none]\ntime: @hourly\ncatchup: none\n\n[once]\ntime: @hourly\n\n" \
+              "[all]\ntime: @hourly\ncatchup: all\n\n[max]\ntime: @hourly\ncatchup: max:3\n\n" \
+              "[interval]\ninterval: 2h\ncatchup: all\n"
+
+    def test_catchup(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "crontab.ini"), "w") as fobj:
+                fobj.write(self.crontab)
+
+            # The last saved state is from midnight, we start at 9:30.
+            next_run = to_seconds(dt(1970, 1, 5, 0, 0))
+            with open(os.path.join(directory, "state.db"), "wb") as fobj:
+                write_state(fobj, dict((name, next_run) for name in
+                                       ("none", "once", "all", "max", "interval")))
+
+            time_provider = TestTimeProvider(dt(1970, 1, 5, 9, 30), dt(1970, 1, 5, 11, 30, 59))
+            with TestScheduler(time_provider, directory) as scheduler:
+                scheduler.mainloop()
+                scheduler.logfile.close()
+
+        # The missed runs at 0:00 to 9:00, and 10:00 and 11:00 as usual.
+        self.assertEqual(scheduler.counter["none"], 2)
+        self.assertEqual(scheduler.counter["once"], 3)
+        self.assertEqual(scheduler.counter["all"], 12)
+        self.assertEqual(scheduler.counter["max"], 5)
+        # The missed runs at 0:00 to 8:00, and the next one at 11:30.
+        self.assertEqual(scheduler.counter["interval"], 6)
+        self.assertEqual(scheduler.crontab["interval"].last_run, to_seconds(dt(1970, 1, 5, 11, 30)))
+
+    def test_field(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".ini") as fobj:
+            fobj.write("[foo]\ncommand: foo\ntime: @hourly\ncatchup: max:0\n")
+            fobj.flush()
+            with self.assertRaisesRegex(CrontabError, r":4: catchup maximum"):
+                CrontabParser(fobj.name, TestJob).parse()
+
+
+class RestartTimeProvider(TestTimeProvider):
+
+    def sleep(self, seconds, fds=()):
+        # Ask for a hot restart instead of terminating.
+        signum = super().sleep(seconds, fds)
+        return signal.SIGUSR2 if signum == signal.SIGTERM else signum
+
+
+class RestartTest(unittest.TestCase):
+
+    crontab = "[default]\nmail: never\nloglevel: debug\ncommand: 30 0\ntime: @hourly\n\n" \
+              "[foo]\n\n[bar]\nqueue: foo\n\n[boot]\ntime: @reboot\ncommand: 1 0\n"
+
+    def test_restart(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "crontab.ini"), "w") as fobj:
+                fobj.write(self.crontab)
+
+            # foo is running and bar is waiting for it at 9:10.
+            time_provider = RestartTimeProvider(dt(1970, 1, 5, 8, 59, 59), dt(1970, 1, 5, 9, 10))
+            with TestScheduler(time_provider, directory) as scheduler:
+                scheduler.mainloop()
+                scheduler.logfile.close()
+
+            self.assertTrue(scheduler.restart)
+            self.assertEqual(scheduler.counter, {"foo": 1, "boot": 1})
+            [job] = scheduler.running.values()
+            running = job.id
+            waiting = scheduler.queues["foo"].peek().id
+            job.close()
+            self.assertTrue(os.path.exists(os.path.join(directory, "checkpoint.json")))
+
+            time_provider = TestTimeProvider(dt(1970, 1, 5, 9, 10), dt(1970, 1, 5, 10, 59, 59))
+            with TestScheduler(time_provider, directory, adopt=True) as scheduler:
+                self.assertEqual([job.id for job in scheduler.running.values()], [running])
+                self.assertEqual([job.id for job in scheduler.queues["foo"]], [waiting])
+                serial = dict(scheduler.Job._serial)
+                scheduler.mainloop()
+                scheduler.logfile.close()
+
+            self.assertFalse(scheduler.restart)
+            self.assertFalse(os.path.exists(os.path.join(directory, "checkpoint.json")))
+            # bar at 9:30, then foo at 10:00 and bar at 10:30 as usual. The
+            # @reboot job is not run again.
+            self.assertEqual(scheduler.counter, {"foo": 1, "bar": 2})
+
+            # The job ids are not reused.
+            with open(os.path.join(directory, "logfile.txt")) as fobj:
+                log = fobj.read()
+            self.assertEqual(len(re.findall(r"foo-%04d +execute:" % serial["foo"], log)), 1)
+            self.assertEqual(len(re.findall(r"%s +execute:" % running, log)), 1)
+
+    def test_missing_checkpoint(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "crontab.ini"), "w") as fobj:
+                fobj.write(self.crontab)
+
+            time_provider = TestTimeProvider(dt(1970, 1, 5, 8, 59, 59), dt(1970, 1, 5, 9, 10))
+            with TestScheduler(time_provider, directory, adopt=True) as scheduler:
+                self.assertEqual(scheduler.running, {})
+                scheduler.mainloop()
+                scheduler.logfile.close()
+
+            self.assertEqual(scheduler.counter, {"foo": 1})
+
+
+class StateTest(unittest.TestCase):
+
+    jobs = {"foo": 86400, "foo.bar": -60, "b\u00e4z": 2 ** 35}
+
+    def test_state(self):
+        with tempfile.TemporaryFile() as fileobj:
+            write_state(fileobj, self.jobs)
+            fileobj.seek(0)
+            self.assertEqual(read_state(fileobj), (self.jobs, False))
+
+            with StateFile(fileobj) as state:
+                self.assertEqual(len(state), 3)
+                for name, value in self.jobs.items():
+                    self.assertEqual(state.get(name), value)
+                self.assertIsNone(state.get("bar"))
+                self.assertIsNone(state.get("zzz"))
+
+    def test_empty(self):
+        with tempfile.TemporaryFile() as fileobj:
+            write_state(fileobj, {})
+            fileobj.seek(0)
+            self.assertEqual(read_state(fileobj), ({}, False))
+
+    def test_truncated(self):
+        with tempfile.TemporaryFile() as fileobj:
+            write_state(fileobj, self.jobs)
+            fileobj.truncate(fileobj.tell() - 1)
+            fileobj.seek(0)
+            self.assertRaises(StateError, read_state, fileobj)
+
+    def test_corrupt(self):
+        buf = io.BytesIO()
+        write_state(buf, self.jobs)
+        data = buf.getvalue()
+
+        # An invalid character in a name, and a name that is split in two so
+        # that the number of names does not match the number of values.
+        for byte in (b"\xff", b"\0"):
+            with tempfile.TemporaryFile() as fileobj:
+                fileobj.write(data[:-2] + byte + data[-1:])
+                fileobj.flush()
+                fileobj.seek(0)
+                self.assertRaises(StateError, read_state, fileobj)
+
+        with tempfile.TemporaryFile() as fileobj:
+            fileobj.write(data[:-2] + b"\xff" + data[-1:])
+            fileobj.flush()
+            with StateFile(fileobj) as state:
+                self.assertRaises(StateError, state.get, "foo.bar")
+
+    def test_legacy(self):
+        state = {"tag": 1, "jobs": dict((name, to_datetime(value)) for name, value in self.jobs.items())}
+        self.assertEqual(read_state(io.BytesIO(pickle.dumps(state))), (self.jobs, True))
+
+        self.assertRaises(StateError, read_state, io.BytesIO(pickle.dumps({"tag": 0, "jobs": {}})))
+        self.assertRaises(StateError, read_state, io.BytesIO(b""))
+
+        # Only datetime objects may be loaded from the pickle.
+        evil = pickle.dumps({"tag": 1, "jobs": {"foo": unittest.mock.sentinel.foo}})
+        self.assertRaises(StateError, read_state, io.BytesIO(evil))
+
+    def test_migration(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "crontab.ini"), "w") as fobj:
+                fobj.write("[foo]\ncommand: 1 0\ntime: 0 0 * * *\n")
+
+            next_run = dt(1970, 1, 9, 0, 0)
+            with open(os.path.join(directory, "state.db"), "wb") as fobj:
+                pickle.dump({"tag": 1, "jobs": {"foo": next_run, "bar": next_run}}, fobj)
+
+            with TestScheduler(TestTimeProvider(), directory) as scheduler:
+                self.assertEqual(scheduler.crontab["foo"].next_run, to_seconds(next_run))
+                scheduler.logfile.close()
+
+            with open(os.path.join(directory, "state.db"), "rb") as fobj:
+                self.assertEqual(fobj.read(len(MAGIC)), MAGIC)
+                fobj.seek(0)
+                self.assertEqual(read_state(fobj), ({"foo": to_seconds(next_run)}, False))
+
+
+class ControllerTest(unittest.TestCase):
+
+    pcrond = load_script("pcrond")
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        os.mkdir(os.path.join(self.directory.name, ".pcron"))
+        self.crontab_path = os.path.join(self.directory.name, ".pcron", "crontab.ini")
+        with open(self.crontab_path, "w") as fobj:
+            fobj.write("[foo]\ncommand: true\ntime: @hourly\n")
+
+        self.record = pwd.struct_passwd(("foo", "x", os.getuid(), os.getgid(), "",
+                                         self.directory.name, "/bin/sh"))
+        self.controller = self.pcrond.Controller(os.path.join(self.directory.name, "pcrond.log"),
+                                                 "C", None, "pcron", 15)
+        self.instance = self.controller.instances["foo"] = self.pcrond.Instance("foo", self.record)
+        self.instance.start_time = time.monotonic()
+        self.controller.running.add("foo")
+
+    def tearDown(self):
+        self.controller.logfile.close()
+        self.directory.cleanup()
+
+    def get_delay(self):
+        return round(self.instance.restart_time - time.monotonic())
+
+    def test_backoff(self):
+        Controller = self.pcrond.Controller
+        for delay in (10, 20, 40, 80, 160):
+            self.controller.instance_exited(self.instance)
+            self.assertEqual(self.get_delay(), delay)
+
+        # After MAX_FAILURES exits the instance is given up.
+        self.controller.instance_exited(self.instance)
+        self.assertEqual(self.instance.failures, Controller.MAX_FAILURES + 1)
+        self.assertIsNone(self.instance.restart_time)
+        self.controller.restart_instances()
+        self.assertFalse(self.controller.needs_start("foo", self.record))
+
+        # Until the crontab is modified.
+        os.utime(self.crontab_path, (0, 0))
+        self.assertTrue(self.controller.needs_start("foo", self.record))
+        self.assertEqual(self.instance.failures, 0)
+
+    def test_max_delay(self):
+        self.instance.failures = self.pcrond.Controller.MAX_FAILURES - 1
+        with unittest.mock.patch.object(self.pcrond.Controller, "MAX_RESTART_DELAY", 60):
+            self.controller.instance_exited(self.instance)
+        self.assertEqual(self.get_delay(), 60)
+
+    def test_stable(self):
+        for _ in range(3):
+            self.controller.instance_exited(self.instance)
+        self.assertEqual(self.get_delay(), 40)
+
+        # An instance that ran long enough starts over with the initial delay.
+        self.instance.start_time = time.monotonic() - self.pcrond.Controller.STABLE_TIME
+        self.controller.instance_exited(self.instance)
+        self.assertEqual(self.instance.failures, 1)
+        self.assertEqual(self.get_delay(), 10)
+
+    def test_restart(self):
+        self.controller.instance_exited(self.instance)
+        self.instance.restart_time = time.monotonic()
+
+        with unittest.mock.patch.object(self.controller, "start_user_instances") as start:
+            self.controller.restart_instances()
+        start.assert_called_once_with([("foo", self.record)])
+        self.assertIsNone(self.instance.restart_time)
+
+    def test_single_process(self):
+        self.controller.running.clear()
+        self.controller.schedulers = TestMultiScheduler(self.controller.time_provider,
+                                                        NullLogger().new("multi"))
+        self.controller.start_user_instances([("foo", self.record)])
+        self.assertIn("foo", self.controller.running)
+        self.assertIn("foo", self.controller.schedulers.schedulers)
+
+        # A scheduler that failed is restarted after a delay.
+        scheduler = self.controller.schedulers.schedulers["foo"][1]
+        self.addCleanup(scheduler.logfile.close)
+        self.controller.schedulers.call("foo", "step_that_does_not_exist")
+        self.controller.check_schedulers()
+        self.assertEqual(self.get_delay(), 10)
+        self.assertNotIn("foo", self.controller.schedulers.schedulers)
+
+        self.instance.restart_time = time.monotonic()
+        self.controller.restart_instances()
+        self.assertIn("foo", self.controller.running)
+        self.assertIn("foo", self.controller.schedulers.schedulers)
+        self.assertIsNone(self.instance.restart_time)
+        scheduler = self.controller.schedulers.schedulers["foo"][1]
+        self.addCleanup(scheduler.logfile.close)
+        self.controller.schedulers.shutdown()
+
+    def test_check_interval(self):
+        Controller = self.pcrond.Controller
+        log_path = os.path.join(self.directory.name, "pcrond.log")
+        self.assertEqual(self.controller.check_interval, 15)
+
+        controller = Controller(log_path, "C", None, "pcron", None)
+        controller.logfile.close()
+        self.assertEqual(controller.check_interval, Controller.CHECK_INTERVAL)
+
+        controller = Controller(log_path, "C", None, "pcron", None, watch=True)
+        self.addCleanup(controller.logfile.close)
+        if controller.inotify is None:
+            self.skipTest("inotify is not available")
+        self.addCleanup(os.close, controller.inotify.fileno())
+        self.assertEqual(controller.check_interval, Controller.WATCH_CHECK_INTERVAL)
+
+        # If the watches are exhausted, the checks are the fallback again.
+        with unittest.mock.patch.object(controller.inotify, "add_watch", side_effect=OSError):
+            controller.add_watch("foo", self.record, self.directory.name, IN_CREATE)
+        self.assertEqual(controller.check_interval, Controller.CHECK_INTERVAL)
+
+    @unittest.skipUnless(hasattr(os, "pidfd_open"), "requires pidfds")
+    def test_wait(self):
+        # A pidfd beyond FD_SETSIZE must not break the main loop.
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard != resource.RLIM_INFINITY and hard <= 2048:
+            self.skipTest("RLIMIT_NOFILE is too low")
+        resource.setrlimit(resource.RLIMIT_NOFILE, (max(soft, 4096), hard))
+        self.addCleanup(resource.setrlimit, resource.RLIMIT_NOFILE, (soft, hard))
+
+        process = subprocess.Popen(["true"])
+        pidfd = os.pidfd_open(process.pid)
+        try:
+            with unittest.mock.patch("os.pidfd_open", return_value=os.dup2(pidfd, 2048)):
+                self.controller.supervise("foo", self.record, process.pid)
+            self.assertEqual(self.instance.pidfd, 2048)
+            self.controller.wait(1)
+        finally:
+            os.close(pidfd)
+            process.wait()
+
+        self.assertIsNone(self.instance.pidfd)
+        self.assertIsNone(self.instance.pid)
+        self.assertEqual(self.instance.failures, 1)
+        self.assertIsNotNone(self.instance.restart_time)
+
+
 if __name__ == "__main__":
     unittest.main()
 